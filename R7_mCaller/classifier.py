@@ -1,13 +1,11 @@
 import cPickle
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.neural_network import MLPClassifier
-from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import GroupKFold
-from sklearn.model_selection import GroupShuffleSplit
 
 def random_forest(signals,labels,train,groups=None):
     modfiname = 'random_forest_model.pkl'
     if train:
+        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.model_selection import cross_val_score
+        from sklearn.model_selection import GroupKFold
         #modfi = open(modfiname,'wb')
         model = RandomForestClassifier()
         gkf = GroupKFold(n_splits=5)
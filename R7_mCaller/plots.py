@@ -1,7 +1,6 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
-
 def plot_realignment(realigned_signal,t_model):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     fig = plt.figure()
     sns.set_style('white')
     plt.plot(range(len(realigned_signal)),[t_model.model['A'.join(x[1].split('M'))][0] for x in realigned_signal],color='red',label='reference')
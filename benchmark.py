@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#Throughput benchmarks for mCaller on synthetic data from synthetic_data.py: eventalign parsing, extract_features with each
+#engine, distribute_threads over a range of process counts, make_bed aggregation and train_classifier. Every benchmark runs
+#in a fresh python process so that its peak memory is its own, and results are saved as JSON to compare runs over time
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+MCALLER_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+def count_lines(filename):
+    with open(filename,'rb') as fi:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: fi.read(1<<20),b''))
+
+def tsv_rows(tsvname):
+    from eventalign_index import get_index
+    return int(get_index(tsvname)['block_rows'].sum())
+
+#the parsing done by the original extract_features loop for every row
+def per_line(filename):
+    nrows = 0
+    with open(filename,'r') as tsv:
+        tsv.readline()
+        for line in tsv:
+            chrom, read_pos, read_kmer, read_name, x, read_ind, event_current, event_sd, y, ref_kmer, model_current, ref_sd, z, all_current_values  = line.split('\t')
+            read_pos = int(read_pos)
+            read_ind = int(read_ind)
+            diff = float(event_current)-float(model_current)
+            nrows += 1
+    return nrows
+
+def columnar(filename):
+    from parse_eventalign import read_chunks,parse_chunk
+    from eventalign_index import get_index
+    nrows = 0
+    for chunk in read_chunks(filename,get_index(filename)['header_end']):
+        nrows += len(parse_chunk(chunk)['position'])
+    return nrows
+
+#columnar parsing plus handing each row to a python loop
+def columnar_rows(filename):
+    from parse_eventalign import read_chunks,iter_rows
+    from eventalign_index import get_index
+    nrows = 0
+    for row in iter_rows(read_chunks(filename,get_index(filename)['header_end'])):
+        nrows += 1
+    return nrows
+
+PARSERS = {'per_line':per_line,'columnar':columnar,'columnar_rows':columnar_rows}
+
+#each benchmark gets the generated data set and its own settings, and returns what it measured; time spent loading
+#inputs (read qualities, indexes) is left out where it can be
+def bench_parse(data,parser):
+    tsv_rows(data['tsv'])
+    tstart = time.time()
+    nrows = PARSERS[parser](data['tsv'])
+    seconds = time.time()-tstart
+    return {'seconds':seconds,'rows':nrows,'rows_per_s':nrows/seconds}
+
+def bench_train(data,classifier,k,modelfile):
+    from extract_contexts import extract_features,label_names
+    from read_qual import extract_read_quality
+    from eventalign_index import get_index
+    from train_model import train_classifier,pos2label
+    import io
+    read_table = extract_read_quality(data['fastq'])
+    pos_label = pos2label(data['positions'])
+    start = get_index(data['tsv'])['header_end']
+    tstart = time.time()
+    records = extract_features(data['tsv'],data['reference'],read_table,k,0,0,modelfile,classifier,start,train=True,pos_label=pos_label,
+                               base=data['base'],positions_list=data['positions'],outfi=io.StringIO())
+    extract_seconds = time.time()-tstart
+    labels = np.array(label_names(pos_label))[records['label']]
+    tstart = time.time()
+    train_classifier(records['features'],labels,records['context'],modelfile,classifier)
+    seconds = time.time()-tstart
+    return {'seconds':seconds,'observations':len(records),'obs_per_s':len(records)/seconds,'extract_seconds':extract_seconds}
+
+def bench_extract(data,engine,k,modelfile,output):
+    from extract_contexts import extract_features,load_model
+    from read_qual import extract_read_quality
+    from eventalign_index import get_index
+    read_table = extract_read_quality(data['fastq'])
+    start = get_index(data['tsv'])['header_end']
+    load_model(modelfile)
+    nrows = tsv_rows(data['tsv'])
+    tstart = time.time()
+    with open(output,'w') as outfi:
+        extract_features(data['tsv'],data['reference'],read_table,k,0,0,modelfile,'NN',start,base=data['base'],positions_list=data['positions'],
+                         outfi=outfi,engine=engine)
+    seconds = time.time()-tstart
+    nobs = count_lines(output)
+    return {'seconds':seconds,'rows':nrows,'observations':nobs,'rows_per_s':nrows/seconds,'obs_per_s':nobs/seconds}
+
+def bench_distribute(data,nprocs,k,modelfile,output,engine='loop'):
+    from mCaller_nanopolish import distribute_threads
+    from read_qual import extract_read_quality
+    read_table = extract_read_quality(data['fastq'],nprocs=nprocs)
+    nrows = tsv_rows(data['tsv'])
+    tstart = time.time()
+    distribute_threads(data['positions'],None,data['tsv'],read_table,data['reference'],data['base'],'m6A',nprocs,k,False,modelfile,0,0,'NN',
+                       tsv_output=output,engine=engine)
+    seconds = time.time()-tstart
+    nobs = count_lines(output)
+    return {'seconds':seconds,'rows':nrows,'observations':nobs,'rows_per_s':nrows/seconds,'obs_per_s':nobs/seconds}
+
+def bench_make_bed(data,diffs,output):
+    from make_bed import aggregate_by_pos
+    tstart = time.time()
+    aggregate_by_pos(diffs,output,1,0.5,None,False)
+    seconds = time.time()-tstart
+    ncalls = count_lines(diffs)
+    return {'seconds':seconds,'rows':ncalls,'sites':count_lines(output),'rows_per_s':ncalls/seconds}
+
+BENCHMARKS = {'parse':bench_parse,'train_classifier':bench_train,'extract_features':bench_extract,'distribute_threads':bench_distribute,'make_bed':bench_make_bed}
+
+#run one benchmark in this process and print its result, with peak memory of this process and of any worker processes
+def run_child(name,config):
+    result = BENCHMARKS[name](**json.loads(config))
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+    result['peak_worker_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.
+    print(RESULT_PREFIX+json.dumps(result))
+
+#run one benchmark in a fresh process, returning its settings and results (or the error it ended with)
+def run_benchmark(name,logfile,**config):
+    cmd = [sys.executable,os.path.abspath(__file__),'--run',name,'--config',json.dumps(config)]
+    out = subprocess.run(cmd,cwd=MCALLER_DIR,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    logfile.write(' '.join(cmd)+'\n'+out.stdout+'\n')
+    result = {'benchmark':name}
+    result.update({key:value for key,value in config.items() if key != 'data'})
+    lines = [line for line in out.stdout.split('\n') if line.startswith(RESULT_PREFIX)]
+    if out.returncode != 0 or not lines:
+        result['error'] = out.stdout.strip().split('\n')[-1]
+    else:
+        result.update(json.loads(lines[-1][len(RESULT_PREFIX):]))
+    describe = ' '.join(str(config[key]) for key in ['parser','engine','nprocs','classifier'] if key in config)
+    if 'error' in result:
+        print('%-20s %-12s failed: %s' % (name,describe,result['error']))
+    else:
+        rates = ''.join(' %12.0f %s' % (result[key],key) for key in ['rows_per_s','obs_per_s'] if key in result)
+        print('%-20s %-12s %8.2f s%s %8.1f MB peak%s' % (name,describe,result['seconds'],rates,max(result['peak_rss_mb'],result['peak_worker_rss_mb']),
+              '' if name != 'distribute_threads' else ' (%.1f MB per worker)' % result['peak_worker_rss_mb']))
+    sys.stdout.flush()
+    return result
+
+#process counts for distribute_threads: doubling up to maxprocs, and maxprocs itself
+def process_counts(maxprocs):
+    counts = []
+    nprocs = 1
+    while nprocs < maxprocs:
+        counts.append(nprocs)
+        nprocs *= 2
+    return counts+[maxprocs]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=MCALLER_DIR,stderr=subprocess.DEVNULL,universal_newlines=True).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def main():
+    #parse command line options
+    from argparse import ArgumentParser,SUPPRESS
+    parser = ArgumentParser(description='Benchmark mCaller on synthetic data and save the results as JSON')
+    parser.add_argument('--run',type=str,required=False,help=SUPPRESS)
+    parser.add_argument('--config',type=str,required=False,help=SUPPRESS)
+    parser.add_argument('-r','--reference',type=str,required=False,help='fasta file to draw reads from (default: a random sequence of --genome_size bases)')
+    parser.add_argument('-g','--genome_size',type=int,required=False,help='length of the random reference (default 200000)',default=200000)
+    all_or_some = parser.add_mutually_exclusive_group(required=False)
+    all_or_some.add_argument('-p','--positions',type=str,required=False,help='positions to methylate (default: the motif)')
+    all_or_some.add_argument('-m','--motif',type=str,required=False,help='motif to methylate (default GATC)')
+    reads_or_coverage = parser.add_mutually_exclusive_group(required=False)
+    reads_or_coverage.add_argument('-n','--reads',type=int,required=False,help='number of reads')
+    reads_or_coverage.add_argument('-c','--coverage',type=float,required=False,help='mean coverage (default 10)')
+    parser.add_argument('-l','--read_length',type=int,required=False,help='mean read length (default 5000)',default=5000)
+    parser.add_argument('--noise',type=float,required=False,help='event noise as a multiple of the model standard deviation (default 1.0)',default=1.)
+    parser.add_argument('-t','--threads',type=int,required=False,help='largest number of processes for distribute_threads, which is run at 1, 2, 4, ... and this many (default: all cpus)',
+                        default=os.cpu_count())
+    parser.add_argument('-k','--num_variables',type=int,required=False,help='number of variables (default 6)',default=6)
+    parser.add_argument('--classifier',type=str,required=False,help='classifier trained by the train_classifier benchmark and used by the others (default NN)',default='NN')
+    parser.add_argument('--only',type=str,nargs='+',required=False,choices=sorted(BENCHMARKS),help='run only these benchmarks')
+    parser.add_argument('-w','--workdir',type=str,required=False,help='directory for the data and outputs, kept afterwards (default: a temporary directory)')
+    parser.add_argument('-o','--output',type=str,required=False,help='JSON file for the results (default benchmark_<date>_<time>.json)')
+    args = parser.parse_args()
+
+    if args.run:
+        run_child(args.run,args.config)
+        return
+
+    from synthetic_data import generate,write_random_reference
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='mcaller_bench_')
+    if not os.path.isdir(workdir):
+        os.mkdir(workdir)
+    output = args.output or 'benchmark_'+time.strftime('%Y%m%d_%H%M%S')+'.json'
+    if args.reference:
+        refname = os.path.abspath(args.reference)
+    else:
+        refname = os.path.join(workdir,'reference.fasta')
+        write_random_reference(refname,args.genome_size)
+    motif = args.motif or (None if args.positions else 'GATC')
+    tstart = time.time()
+    data = generate(refname,os.path.join(MCALLER_DIR,'template_median68pA.model'),os.path.join(workdir,'synthetic'),motif=motif,
+                    positions=os.path.abspath(args.positions) if args.positions else None,nreads=args.reads,
+                    coverage=args.coverage if args.coverage or args.reads else 10.,read_length=args.read_length,noise=args.noise)
+    generate_seconds = time.time()-tstart
+    data = {'tsv':data['tsv'],'fastq':data['fastq'],'positions':data['positions'],'reference':refname,'base':'A','reads':data['reads'],'rows':data['rows'],'sites':data['sites']}
+
+    selected = args.only or sorted(BENCHMARKS)
+    modelfile = os.path.join(workdir,'model_'+args.classifier+'_'+str(args.num_variables)+'_m6A.pkl')
+    diffs = os.path.join(workdir,'synthetic.diffs')
+    results = []
+    with open(os.path.join(workdir,'benchmark.log'),'w') as logfile:
+        if 'parse' in selected:
+            for parser_name in sorted(PARSERS):
+                results.append(run_benchmark('parse',logfile,data=data,parser=parser_name))
+        #the trained model is needed by every benchmark that classifies
+        if set(selected) & {'train_classifier','extract_features','distribute_threads','make_bed'}:
+            results.append(run_benchmark('train_classifier',logfile,data=data,classifier=args.classifier,k=args.num_variables,modelfile=modelfile))
+        if 'extract_features' in selected:
+            for engine in ['loop','block']:
+                results.append(run_benchmark('extract_features',logfile,data=data,engine=engine,k=args.num_variables,modelfile=modelfile,
+                                             output=os.path.join(workdir,'extract_'+engine+'.diffs')))
+        if set(selected) & {'distribute_threads','make_bed'}:
+            for nprocs in process_counts(args.threads) if 'distribute_threads' in selected else [args.threads]:
+                results.append(run_benchmark('distribute_threads',logfile,data=data,nprocs=nprocs,k=args.num_variables,modelfile=modelfile,output=diffs))
+        if 'make_bed' in selected:
+            results.append(run_benchmark('make_bed',logfile,data=data,diffs=diffs,output=os.path.join(workdir,'synthetic.summary.bed')))
+
+    report = {'date':time.strftime('%Y-%m-%d %H:%M:%S'),'commit':git_commit(),'host':platform.node(),'platform':platform.platform(),
+              'python':platform.python_version(),'numpy':np.__version__,'cpus':os.cpu_count(),
+              'settings':{key:value for key,value in vars(args).items() if key not in ['run','config']},
+              'data':dict(data,generate_seconds=generate_seconds),'results':results}
+    with open(output,'w') as outfi:
+        json.dump(report,outfi,indent=1)
+    print('results saved to',output)
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#Reading gzip and BGZF (bgzip) compressed input, and writing BGZF. BGZF files are a series of gzip members of at most 64 KB
+#each, so with a .gzi index of where each block starts (the format written by bgzip -i) any byte range of the decompressed
+#data can be read by decompressing only the blocks it covers, and every process can decompress its own part of the file
+
+import io
+import numpy as np
+import os
+import struct
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+#gzip header of a BGZF block up to its BC extra subfield, which holds the block size
+BGZF_HEADER = struct.Struct('<4sI2sHBBH')
+#empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+#data compressed into each block, as by htslib, which leaves room for incompressible data
+BGZF_BLOCK_DATA = 0xff00
+
+def gzi_name(filename):
+    return filename+'.gzi'
+
+def is_gzip(filename):
+    with open(filename,'rb') as fi:
+        return fi.read(2) == GZIP_MAGIC
+
+#size of the BGZF block starting at offset, or None if there is not one there
+def bgzf_block_size(fi,offset):
+    fi.seek(offset)
+    header = fi.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size:
+        return None
+    magic,mtime,xfl_os,xlen,si1,si2,slen = BGZF_HEADER.unpack(header)
+    if magic != b'\x1f\x8b\x08\x04' or (si1,si2,slen) != (66,67,2):
+        return None
+    return struct.unpack('<H',fi.read(2))[0]+1
+
+def is_bgzf(filename):
+    with open(filename,'rb') as fi:
+        return bgzf_block_size(fi,0) is not None
+
+#compressed and decompressed offsets at which each block starts, plus the end of the file and of the data
+def scan_blocks(filename):
+    coffsets,ustarts = [],[]
+    size = os.path.getsize(filename)
+    offset,ustart = 0,0
+    with open(filename,'rb') as fi:
+        while offset < size:
+            block_size = bgzf_block_size(fi,offset)
+            if block_size is None:
+                raise ValueError('%s is not BGZF compressed after byte %d (recompress with bgzip)' % (filename,offset))
+            fi.seek(offset+block_size-4)
+            coffsets.append(offset)
+            ustarts.append(ustart)
+            ustart += struct.unpack('<I',fi.read(4))[0]
+            offset += block_size
+    return np.array(coffsets+[size],dtype=np.int64),np.array(ustarts+[ustart],dtype=np.int64)
+
+#.gzi: number of entries, then compressed and decompressed offsets of every block after the first, as little-endian uint64
+def save_gzi(filename,coffsets,ustarts):
+    tempname = gzi_name(filename)+'.'+str(os.getpid())
+    with open(tempname,'wb') as gzifi:
+        gzifi.write(struct.pack('<Q',len(coffsets)-2))
+        gzifi.write(np.column_stack([coffsets[1:-1],ustarts[1:-1]]).astype('<u8').tobytes())
+    os.replace(tempname,gzi_name(filename))
+
+#returns None if there is no index or it is older than the file. the end of the data is the end of the last block
+def load_gzi(filename):
+    try:
+        if os.path.getmtime(gzi_name(filename)) < os.path.getmtime(filename):
+            return None
+        with open(gzi_name(filename),'rb') as gzifi:
+            count = struct.unpack('<Q',gzifi.read(8))[0]
+            entries = np.frombuffer(gzifi.read(16*count),dtype='<u8').reshape(-1,2).astype(np.int64)
+        if len(entries) != count:
+            return None
+        size = os.path.getsize(filename)
+        with open(filename,'rb') as fi:
+            last = entries[-1,0] if count else 0
+            fi.seek(last+bgzf_block_size(fi,last)-4)
+            end = (entries[-1,1] if count else 0)+struct.unpack('<I',fi.read(4))[0]
+    except (IOError,OSError,ValueError,TypeError,struct.error):
+        return None
+    return np.concatenate(([0],entries[:,0],[size])),np.concatenate(([0],entries[:,1],[end]))
+
+#block offsets are kept for the life of the process, keyed by file
+loaded_gzis = {}
+
+def get_gzi(filename):
+    if filename not in loaded_gzis:
+        blocks = load_gzi(filename)
+        if blocks is None:
+            blocks = scan_blocks(filename)
+            try:
+                save_gzi(filename,*blocks)
+            except (IOError,OSError):
+                print('could not save block index to',gzi_name(filename))
+        loaded_gzis[filename] = blocks
+    return loaded_gzis[filename]
+
+#seekable reader of the decompressed data of a BGZF file, decompressing one block at a time
+class BgzfReader(io.RawIOBase):
+    def __init__(self,filename):
+        self.coffsets,self.ustarts = get_gzi(filename)
+        self.fi = open(filename,'rb')
+        self.pos = 0
+        self.block,self.data = None,b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += int(self.ustarts[-1])
+        self.pos = max(offset,0)
+        return self.pos
+
+    def readinto(self,buf):
+        view = memoryview(buf).cast('B')
+        filled = 0
+        while filled < len(view):
+            #the last block starting at or before the position, which skips empty blocks
+            i = int(np.searchsorted(self.ustarts,self.pos,side='right'))-1
+            if i >= len(self.coffsets)-1:
+                break
+            if i != self.block:
+                self.fi.seek(self.coffsets[i])
+                self.data = zlib.decompress(self.fi.read(int(self.coffsets[i+1]-self.coffsets[i])),31)
+                self.block = i
+            start = self.pos-int(self.ustarts[i])
+            n = min(len(view)-filled,len(self.data)-start)
+            view[filled:filled+n] = self.data[start:start+n]
+            filled += n
+            self.pos += n
+        return filled
+
+    def close(self):
+        self.fi.close()
+        super().close()
+
+#position in the decompressed data of a virtual offset (where a block starts in the file << 16 | offset in the block),
+#the form tabix indexes give file offsets in
+def virtual_position(filename,voffset):
+    coffsets,ustarts = get_gzi(filename)
+    return int(ustarts[np.searchsorted(coffsets,voffset>>16)])+(voffset&0xffff)
+
+#writes BGZF that bgzip, tabix and samtools can read, along with its .gzi if save_index. tell() gives the virtual offset of
+#the next byte
+class BgzfWriter:
+    def __init__(self,filename,level=6,save_index=True):
+        self.filename,self.save_index = filename,save_index
+        self.fi = open(filename,'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.coffsets,self.ustarts = [],[]
+        self.ustart = 0
+
+    def write(self,data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_DATA:
+            self.write_block(bytes(self.buffer[:BGZF_BLOCK_DATA]))
+            del self.buffer[:BGZF_BLOCK_DATA]
+
+    def write_block(self,data):
+        compressor = zlib.compressobj(self.level,zlib.DEFLATED,-15)
+        cdata = compressor.compress(data)+compressor.flush()
+        self.coffsets.append(self.fi.tell())
+        self.ustarts.append(self.ustart)
+        self.fi.write(BGZF_HEADER.pack(b'\x1f\x8b\x08\x04',0,b'\x00\xff',6,66,67,2)+struct.pack('<H',len(cdata)+25))
+        self.fi.write(cdata+struct.pack('<II',zlib.crc32(data),len(data)))
+        self.ustart += len(data)
+
+    def tell(self):
+        return (self.fi.tell()<<16)|len(self.buffer)
+
+    def close(self):
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        end = self.fi.tell()
+        self.fi.write(BGZF_EOF)
+        self.fi.close()
+        if self.save_index and self.coffsets:
+            save_gzi(self.filename,np.array(self.coffsets+[end],dtype=np.int64),np.array(self.ustarts+[self.ustart],dtype=np.int64))
+
+#a binary file object for a plain, gzip or BGZF file. BGZF files can be seeked cheaply, gzip files only by decompressing
+#everything before the new position
+def open_input(filename,buffering=1<<20):
+    if is_bgzf(filename):
+        return io.BufferedReader(BgzfReader(filename),buffer_size=buffering)
+    if is_gzip(filename):
+        import gzip
+        return gzip.open(filename,'rb')
+    return open(filename,'rb',buffering=buffering)
+
+#length of the (decompressed) data in a file, or None for gzip files, which would have to be read through to find out
+def input_size(filename):
+    if is_bgzf(filename):
+        return int(get_gzi(filename)[1][-1])
+    if is_gzip(filename):
+        return None
+    return os.path.getsize(filename)
+
+#input that can be split into byte ranges for processes to read separately: plain or BGZF, but not gzip
+def is_splittable(filename):
+    return not is_gzip(filename) or is_bgzf(filename)
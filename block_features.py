@@ -0,0 +1,66 @@
+#Observations for a whole read block at once with array operations, giving the same results as the row loop in extract_features
+
+import numpy as np
+
+#returns (reverse strand, methylated positions, mean difference at each kmer position (0 if skipped), number of skipped kmer
+#positions, positions followed directly by another methylated position) for one read block, or None if the block has to go
+#through the row loop: rows going back along the reference, a strand that changes within the read, or a site at position 0.
+#
+#with positions that never decrease, the loop keeps one observation per run of consecutive rows whose kmer covers the same
+#next site. a run continues the previous run's differences when it starts on the row right after it and within skip_thresh+1
+#of its site, and each kmer position of an observation averages the rows of its chain of runs at that distance from the site
+def block_observations(rows,k,skip_thresh):
+    positions = rows['position']
+    rev = rows['reference_kmer'] != rows['model_kmer']
+    offsets = np.where(rev,rows['rev_offset'],rows['fwd_offset'])
+    captured = np.flatnonzero(offsets < k)
+    if len(captured) == 0:
+        return False,[],[],[],[]
+    #the first row with a site picks the strand by its kmers, later rows by their event index relative to it
+    first = captured[0]
+    rev = bool(rev[first])
+    if ((rows['event_index'][first+1:] <= rows['event_index'][first]) != rev).any() or (np.diff(positions[first:]) < 0).any():
+        return None
+    positions = positions[first:]
+    offsets = rows['rev_offset' if rev else 'fwd_offset'][first:]
+    event_diffs = rows['event_diff'][first:]
+    has_site = offsets < k
+    sites = positions+offsets
+    if (sites[has_site] == 0).any():
+        return None
+
+    #runs of rows with the same next site
+    prev_has_site = np.append(False,has_site[:-1])
+    starts = np.flatnonzero(has_site & (~prev_has_site | (sites != np.append(-1,sites[:-1]))))
+    mpos = sites[starts]
+    chained = np.append(False,prev_has_site[starts[1:]] & (positions[starts[1:]] <= mpos[:-1]+skip_thresh+1))
+    chains = np.cumsum(~chained)
+    multi_meth = mpos[:-1][chained[1:] & (offsets[starts[1:]] != 0)]
+
+    #each row counts towards its own run and any later runs of the same chain whose site is still within its kmer
+    row_ids = np.flatnonzero(has_site)
+    row_runs = np.searchsorted(starts,row_ids,side='right')-1
+    targets,slots,members = [],[],[]
+    for ahead in range(k):
+        target = row_runs+ahead
+        valid = target < len(starts)
+        valid[valid] = (chains[target[valid]] == chains[row_runs[valid]]) & (mpos[target[valid]]-positions[row_ids[valid]] < k)
+        if not valid.any():
+            break
+        targets.append(target[valid])
+        slots.append(mpos[target[valid]]-positions[row_ids[valid]])
+        members.append(row_ids[valid])
+    keys = np.concatenate(targets)*k+np.concatenate(slots)
+    members = np.concatenate(members)
+    #group in row order, so that each mean adds up its values in the same order as np.mean on the loop's list
+    order = np.lexsort((members,keys))
+    keys,values = keys[order],event_diffs[members[order]]
+    group_starts = np.flatnonzero(np.append(True,keys[1:] != keys[:-1]))
+    counts = np.diff(np.append(group_starts,len(keys)))
+    means = np.zeros(len(starts)*k)
+    filled = np.zeros(len(starts)*k,dtype=bool)
+    means[keys[group_starts]] = np.add.reduceat(values,group_starts)/counts
+    filled[keys[group_starts]] = True
+    num_skips = k-filled.reshape(-1,k).sum(axis=1)
+    means = np.where(filled,means,0).reshape(-1,k)
+    return rev,mpos.tolist(),means.tolist(),num_skips.tolist(),multi_meth.tolist()
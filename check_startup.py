@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#Check the cold-start time of mCaller_nanopolish.py -v and of one inference worker (a fresh process that imports mCaller,
+#sets up its worker state and loads the model, as a spawned worker does) against a time budget. Exits with status 1 if
+#either is over budget or pulls in a module that only training or plotting needs.
+
+import os
+import subprocess
+import sys
+import time
+
+MCALLER_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINING_MODULES = ['sklearn','matplotlib','seaborn','Bio']
+
+WORKER_CODE = '''
+import sys
+import mCaller_nanopolish
+mCaller_nanopolish.init_worker({'modelfile':sys.argv[1]},'startup_check')
+mCaller_nanopolish.load_model(sys.argv[1])
+print(' '.join(name for name in sys.argv[2:] if name in sys.modules))
+'''
+
+VERSION_CODE = '''
+import sys
+sys.argv = ['mCaller_nanopolish.py','-v']
+import runpy
+try:
+    runpy.run_path('mCaller_nanopolish.py',run_name='__main__')
+except SystemExit:
+    pass
+print(' '.join(name for name in %r if name in sys.modules))
+''' % TRAINING_MODULES
+
+#best wall time in seconds over several fresh interpreters, and the heavy modules the last one imported
+def time_startup(cmd,repeats):
+    best,loaded = None,[]
+    for i in range(repeats):
+        tstart = time.time()
+        out = subprocess.run(cmd,cwd=MCALLER_DIR,stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+        elapsed = time.time()-tstart
+        if out.returncode != 0:
+            print(out.stderr)
+            sys.exit('startup check failed: '+' '.join(cmd[:2]))
+        best = elapsed if best is None else min(best,elapsed)
+        loaded = out.stdout.split('\n')[-2].split()
+    return best,loaded
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Check mCaller start-up time against a budget')
+    parser.add_argument('-d','--modelfile',type=str,required=True,help='model file for the inference worker (.pkl, or .npz to check that scikit-learn is not needed)')
+    parser.add_argument('--version_budget',type=float,required=False,help='seconds allowed for mCaller_nanopolish.py -v (default 0.5)',default=0.5)
+    parser.add_argument('--worker_budget',type=float,required=False,help='seconds allowed for an inference worker to start and load the model (default 1.0)',default=1.0)
+    parser.add_argument('-n','--repeats',type=int,required=False,help='number of runs, the fastest of which is checked (default 3)',default=3)
+    args = parser.parse_args()
+
+    modelfile = os.path.abspath(args.modelfile)
+    assert os.path.isfile(modelfile), 'model file not found at '+modelfile
+    failed = False
+
+    version_time,version_modules = time_startup([sys.executable,'-c',VERSION_CODE],args.repeats)
+    print('mCaller_nanopolish.py -v: %.3f s (budget %.3f s)' % (version_time,args.version_budget))
+    if version_time > args.version_budget:
+        print('  over budget')
+        failed = True
+    if version_modules:
+        print('  imported',', '.join(version_modules),'just to print the version')
+        failed = True
+
+    #scikit-learn is expected when the worker has to unpickle the model, otherwise nothing from TRAINING_MODULES should load
+    from numpy_model import weights_name,is_weights_file
+    weightsfile = weights_name(modelfile)
+    uses_weights = is_weights_file(modelfile) or (os.path.isfile(weightsfile) and os.path.getmtime(weightsfile) >= os.path.getmtime(modelfile))
+    worker_time,worker_modules = time_startup([sys.executable,'-c',WORKER_CODE,modelfile]+TRAINING_MODULES,args.repeats)
+    print('inference worker (%s): %.3f s (budget %.3f s)' % ('numpy weights' if uses_weights else 'pickled model',worker_time,args.worker_budget))
+    if worker_time > args.worker_budget:
+        print('  over budget')
+        failed = True
+    unexpected = [name for name in worker_modules if uses_weights or name != 'sklearn']
+    if unexpected:
+        print('  imported',', '.join(unexpected),'for inference')
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print('ok')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#Checkpoints for resuming an interrupted run: the shard plan of the run, and a journal per worker of the shards it has
+#finished with where their lines (and training records) are in the worker's files
+
+import numpy as np
+import os
+import re
+
+CHECKPOINT_VERSION = 1
+
+def plan_name(tsv_output):
+    return tsv_output+'.ckpt'
+
+def journal_name(partname):
+    return partname+'.ckpt'
+
+#worker files of a run writing to tsv_output, eg. out.diffs.6.1234.part, out.diffs.6.1234.2.part and their .train and .ckpt files
+def worker_files(tsv_output):
+    outdir = os.path.dirname(tsv_output) or '.'
+    pattern = re.compile(re.escape(os.path.basename(tsv_output))+r'\.\d+(\.\d+)?\.part(\.train|\.ckpt)?$')
+    return [os.path.join(os.path.dirname(tsv_output),fi) for fi in os.listdir(outdir) if pattern.match(fi)]
+
+#a worker's output files are named by its process id, with a number added if an earlier run left a file with that name
+def worker_part_name(tsv_output,pid):
+    partname = tsv_output+'.'+str(pid)+'.part'
+    attempt = 1
+    while os.path.exists(partname) or os.path.exists(journal_name(partname)):
+        partname = tsv_output+'.'+str(pid)+'.'+str(attempt)+'.part'
+        attempt += 1
+    return partname
+
+#the shards are saved along with what they were cut from, so a resumed run does the same shards whatever its number of processes
+def save_plan(tsv_output,tsvname,shards,k,train):
+    stat = os.stat(tsvname)
+    with open(plan_name(tsv_output),'wb') as planfi:
+        np.savez(planfi,version=CHECKPOINT_VERSION,size=stat.st_size,mtime=stat.st_mtime,k=k,train=train,
+                 shards=np.array(shards,dtype=np.int64).reshape(-1,2))
+
+#returns the saved shards, or None if there are none for this tsv and settings
+def load_plan(tsv_output,tsvname,k,train):
+    try:
+        with np.load(plan_name(tsv_output),allow_pickle=False) as npz:
+            plan = {key:npz[key] for key in npz.files}
+    except (IOError,OSError,ValueError):
+        return None
+    stat = os.stat(tsvname)
+    if plan['version'] != CHECKPOINT_VERSION or plan['size'] != stat.st_size or plan['mtime'] != stat.st_mtime or plan['k'] != k or plan['train'] != train:
+        return None
+    return [(int(start),int(end)) for start,end in plan['shards']]
+
+#one line per finished shard: shard number, tsv byte range (ending after its last read block), output file and byte range,
+#then training file, offset and number of records (- 0 0 if not training). the worker's files are synced to disk first,
+#so everything up to a journalled offset is complete
+def record_shard(journal,synced,shard,start,end,train_span,out_span):
+    for fi in synced:
+        os.fsync(fi.fileno())
+    trainname,trainoffset,traincount = train_span if train_span else ('-',0,0)
+    journal.write('%d\t%d\t%d\t%s\t%d\t%d\t%s\t%d\t%d\n' % ((shard,start,end)+tuple(out_span)+(trainname,trainoffset,traincount)))
+    journal.flush()
+    os.fsync(journal.fileno())
+
+#finished shards from the journals of an earlier run, as {shard: (training span, output span)}. worker files are cut back
+#to the end of their last finished shard, and files of workers that never finished a shard are removed
+def load_checkpoints(tsv_output,record_size):
+    done = {}
+    files = worker_files(tsv_output)
+    for journal in [fi for fi in files if fi.endswith('.ckpt')]:
+        with open(journal,'r') as journalfi:
+            for line in journalfi:
+                fields = line.rstrip('\n').split('\t')
+                #the last line may be cut short if the worker was killed while writing it
+                if not line.endswith('\n') or len(fields) != 9:
+                    break
+                train_span = None if fields[6] == '-' else (fields[6],int(fields[7]),int(fields[8]))
+                done[int(fields[0])] = (train_span,(fields[3],int(fields[4]),int(fields[5])))
+    keep = {}
+    for train_span,out_span in done.values():
+        keep[out_span[0]] = max(keep.get(out_span[0],0),out_span[2])
+        if train_span:
+            keep[train_span[0]] = max(keep.get(train_span[0],0),train_span[1]+train_span[2]*record_size)
+    for fi in files:
+        if fi in keep:
+            with open(fi,'r+b') as partfi:
+                partfi.truncate(keep[fi])
+        elif not fi.endswith('.ckpt'):
+            os.remove(fi)
+    return done
+
+#remove the plan and journals, once the output is complete or when starting over
+def clear_checkpoints(tsv_output,parts_too=False):
+    for fi in worker_files(tsv_output):
+        if parts_too or fi.endswith('.ckpt'):
+            os.remove(fi)
+    if os.path.exists(plan_name(tsv_output)):
+        os.remove(plan_name(tsv_output))
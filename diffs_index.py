@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#Tabix (.tbi) index for BGZF compressed, sorted mCaller output, and reading the calls in a region (eg. chr:start-end)
+#without decompressing the rest of the file. the index is the one tabix -0 -s 1 -b 3 -e 3 would make, so tabix can query
+#the files too
+
+import gzip
+import io
+import os
+import re
+import struct
+import sys
+
+from bgzf import BgzfWriter,open_input,is_bgzf,virtual_position,get_gzi
+
+TBI_MAGIC = b'TBI\x01'
+#generic format with 0-based positions, contig in column 1 and position in column 3 (each call covers one base)
+TBI_FORMAT,TBI_COL_SEQ,TBI_COL_BEG,TBI_COL_END = 0x10000,1,3,3
+#the linear index has an entry per 16 kb window
+TBI_SHIFT = 14
+
+def tbi_name(filename):
+    return filename+'.tbi'
+
+#the smallest bin of the UCSC binning scheme that holds [beg,end)
+def reg2bin(beg,end):
+    end -= 1
+    for shift,offset in [(14,4681),(17,585),(20,73),(23,9),(26,1)]:
+        if beg>>shift == end>>shift:
+            return offset+(beg>>shift)
+    return 0
+
+#index of output lines as they are written: add each line with the virtual offset it starts at, then finish with the
+#offset after the last line. lines must be grouped by contig and sorted by position within each contig
+class DiffsIndex:
+    def __init__(self):
+        self.contigs,self.bins,self.linear = [],[],[]
+        self.pending,self.last_pos = None,-1
+
+    def add(self,line,voffset):
+        self.close_record(voffset)
+        fields = line.split(b'\t',3)
+        contig,pos = fields[0].decode(),int(fields[2])
+        if not self.contigs or self.contigs[-1] != contig:
+            if contig in self.contigs:
+                raise ValueError('lines of contig '+contig+' are not together, so the output cannot be indexed')
+            self.contigs.append(contig)
+            self.bins.append({})
+            self.linear.append({})
+        elif pos < self.last_pos:
+            raise ValueError('lines of contig '+contig+' are not sorted by position, so the output cannot be indexed')
+        self.pending,self.last_pos = (pos,voffset),pos
+
+    #the chunk of a bin is extended while its lines follow on from each other
+    def close_record(self,vend):
+        if self.pending is None:
+            return
+        pos,vstart = self.pending
+        chunks = self.bins[-1].setdefault(reg2bin(pos,pos+1),[])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart,vend])
+        self.linear[-1].setdefault(pos>>TBI_SHIFT,vstart)
+        self.pending = None
+
+    def save(self,filename,vend):
+        self.close_record(vend)
+        names = b''.join(contig.encode()+b'\x00' for contig in self.contigs)
+        data = [TBI_MAGIC,struct.pack('<8i',len(self.contigs),TBI_FORMAT,TBI_COL_SEQ,TBI_COL_BEG,TBI_COL_END,ord('#'),0,len(names)),names]
+        for bins,linear in zip(self.bins,self.linear):
+            data.append(struct.pack('<i',len(bins)))
+            for bin_number in sorted(bins):
+                data.append(struct.pack('<Ii',bin_number,len(bins[bin_number])))
+                data.extend(struct.pack('<QQ',*chunk) for chunk in bins[bin_number])
+            #windows with no lines start where the next line after them does, as in tabix
+            offsets = [linear.get(window) for window in range(max(linear)+1)]
+            for window in reversed(range(len(offsets)-1)):
+                if offsets[window] is None:
+                    offsets[window] = offsets[window+1]
+            data.append(struct.pack('<i%dQ' % len(offsets),len(offsets),*offsets))
+        outfi = BgzfWriter(filename,save_index=False)
+        outfi.write(b''.join(data))
+        outfi.close()
+
+#{contig: linear index} from a .tbi, along with the column settings
+def load_tbi(filename):
+    data = gzip.decompress(open(filename,'rb').read())
+    if data[:4] != TBI_MAGIC:
+        raise ValueError(filename+' is not a tabix index')
+    nref,fmt,col_seq,col_beg,col_end,meta,skip,lnames = struct.unpack_from('<8i',data,4)
+    offset = 36
+    contigs = data[offset:offset+lnames].split(b'\x00')[:nref]
+    offset += lnames
+    linear = {}
+    for contig in contigs:
+        nbins = struct.unpack_from('<i',data,offset)[0]
+        offset += 4
+        for i in range(nbins):
+            bin_number,nchunks = struct.unpack_from('<Ii',data,offset)
+            offset += 8+16*nchunks
+        nintv = struct.unpack_from('<i',data,offset)[0]
+        linear[contig.decode()] = struct.unpack_from('<%dQ' % nintv,data,offset+4)
+        offset += 4+8*nintv
+    return {'linear':linear,'col_seq':col_seq-1,'col_beg':col_beg-1,'zero_based':bool(fmt&0x10000),'skip':skip,'meta':meta}
+
+#a region as (contig, start, end) in 0-based half-open coordinates from contig, contig:start or contig:start-end
+#(1-based and inclusive, as for samtools and tabix). contig names can themselves contain colons
+def parse_region(region):
+    match = re.match(r'^(.*):([0-9,]+)(?:-([0-9,]+))?$',region)
+    if not match:
+        return region,0,None
+    contig,start,end = match.groups()
+    start = int(start.replace(',',''))
+    end = int(end.replace(',','')) if end else None
+    if start < 1 or (end is not None and end < start):
+        raise ValueError('invalid region '+region)
+    return contig,start-1,end
+
+#index a BGZF compressed mCaller output file that does not have one (eg. compressed with bgzip afterwards)
+def index_diffs(filename):
+    coffsets,ustarts = get_gzi(filename)
+    index = DiffsIndex()
+    block = 0
+    with open_input(filename) as diffs:
+        pos = 0
+        for line in diffs:
+            while pos >= ustarts[block+1] and block+1 < len(ustarts)-1:
+                block += 1
+            index.add(line,int(coffsets[block])<<16|(pos-int(ustarts[block])))
+            pos += len(line)
+    while block+1 < len(ustarts)-1:
+        block += 1
+    index.save(tbi_name(filename),int(coffsets[block])<<16|(pos-int(ustarts[block])))
+
+#lines of a sorted, indexed BGZF file in the region [start,end) of contig, found through the linear index
+def query_region(filename,tbi,contig,start,end,diffs):
+    linear = tbi['linear'].get(contig)
+    if not linear or start>>TBI_SHIFT >= len(linear):
+        return
+    diffs.seek(virtual_position(filename,linear[start>>TBI_SHIFT]))
+    shift = 0 if tbi['zero_based'] else 1
+    for line in diffs:
+        fields = line.split(b'\t',max(tbi['col_seq'],tbi['col_beg'])+1)
+        if fields[tbi['col_seq']].decode() != contig:
+            break
+        pos = int(fields[tbi['col_beg']])-shift
+        if end is not None and pos >= end:
+            break
+        if pos >= start:
+            yield line
+
+#lines of mCaller output (plain, gzip or BGZF compressed) as text, or only those in the given regions. a BGZF file is read
+#through its .tbi index, which is made first if there is none; any other file is read through and filtered
+def read_diffs(filename,regions=None):
+    if not regions:
+        with io.TextIOWrapper(open_input(filename)) as diffs:
+            yield from diffs
+        return
+    regions = [parse_region(region) for region in regions]
+    if not is_bgzf(filename):
+        print('no index for',filename,'(compress it with bgzip to read regions directly) - reading the whole file')
+        with io.TextIOWrapper(open_input(filename)) as diffs:
+            for line in diffs:
+                fields = line.split('\t',3)
+                if len(fields) > 3 and fields[2].isdigit() and any(fields[0] == contig and start <= int(fields[2]) and (end is None or int(fields[2]) < end) for contig,start,end in regions):
+                    yield line
+        return
+    if not os.path.exists(tbi_name(filename)) or os.path.getmtime(tbi_name(filename)) < os.path.getmtime(filename):
+        print('indexing',filename)
+        index_diffs(filename)
+    tbi = load_tbi(tbi_name(filename))
+    #regions are read in file order, and overlapping regions only once
+    contig_order = {contig:i for i,contig in enumerate(tbi['linear'])}
+    regions = sorted(regions,key=lambda region: (contig_order.get(region[0],-1),region[1]))
+    with open_input(filename) as diffs:
+        last = None
+        for contig,start,end in regions:
+            if last is not None and last[0] == contig:
+                if last[2] is None:
+                    continue
+                start = max(start,last[2])
+                if end is not None and end <= start:
+                    continue
+            for line in query_region(filename,tbi,contig,start,end,diffs):
+                yield line.decode()
+            last = (contig,start,end)
+
+def main():
+    #parse command line options
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Print the calls in regions of bgzip compressed mCaller output, indexing it first if needed')
+    parser.add_argument('diffs',type=str,help='mCaller output compressed with bgzip (mCaller_nanopolish.py --bgzip, or bgzip afterwards)')
+    parser.add_argument('regions',type=str,nargs='*',help='regions as contig, contig:start or contig:start-end (1-based, inclusive); with none the file is only indexed')
+    args = parser.parse_args()
+
+    assert is_bgzf(args.diffs), args.diffs+' is not compressed with bgzip'
+    if not args.regions:
+        index_diffs(args.diffs)
+        print('index saved to',tbi_name(args.diffs))
+        return
+    for line in read_diffs(args.diffs,args.regions):
+        sys.stdout.write(line)
+
+if __name__ == "__main__":
+    main()
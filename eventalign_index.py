@@ -0,0 +1,147 @@
+#Sidecar byte-offset index for nanopolish eventalign tsv files, built once and reused between runs
+
+import numpy as np
+import stat
+import sys
+import os
+
+from bgzf import GZIP_MAGIC,open_input,is_splittable
+
+INDEX_VERSION = 2
+
+def index_name(tsvname):
+    return tsvname+'.idx'
+
+#record where each contig and each read block (run of rows with the same contig and read name) starts, plus rows per block.
+#offsets in a BGZF compressed tsv are in its decompressed data, which is data_size bytes long
+def build_index(tsvname):
+    contigs,contig_start = [],[]
+    contig_ids = {}
+    block_start,block_rows,block_contig = [],[],[]
+    last_key = None
+    header_end = 0
+    with open_input(tsvname) as tsv:
+        offset = 0
+        for line in tsv:
+            if offset == 0 and line.startswith(b'contig\t'):
+                header_end = offset = len(line)
+                continue
+            fields = line.split(b'\t',4)
+            key = (fields[0],fields[3])
+            if key != last_key:
+                contig = fields[0].decode()
+                if contig not in contig_ids:
+                    contig_ids[contig] = len(contigs)
+                    contigs.append(contig)
+                    contig_start.append(offset)
+                block_start.append(offset)
+                block_rows.append(0)
+                block_contig.append(contig_ids[contig])
+                last_key = key
+            block_rows[-1] += 1
+            offset += len(line)
+    stat = os.stat(tsvname)
+    return {'version':INDEX_VERSION,
+            'size':stat.st_size,
+            'mtime':stat.st_mtime,
+            'header_end':header_end,
+            'data_size':offset,
+            'contigs':np.array(contigs,dtype=str),
+            'contig_start':np.array(contig_start,dtype=np.int64),
+            'block_start':np.array(block_start,dtype=np.int64),
+            'block_rows':np.array(block_rows,dtype=np.int64),
+            'block_contig':np.array(block_contig,dtype=np.int32)}
+
+def save_index(index,tsvname):
+    with open(index_name(tsvname),'wb') as idxfi:
+        np.savez(idxfi,**index)
+
+#returns None if there is no index or the tsv has changed since it was built
+def load_index(tsvname):
+    try:
+        with np.load(index_name(tsvname),allow_pickle=False) as npz:
+            index = {key:npz[key] for key in npz.files}
+        for key in ['version','size','mtime','header_end','data_size']:
+            index[key] = index[key].item()
+    except (IOError,OSError,ValueError,KeyError):
+        return None
+    stat = os.stat(tsvname)
+    if index['version'] != INDEX_VERSION or index['size'] != stat.st_size or index['mtime'] != stat.st_mtime:
+        return None
+    return index
+
+def get_index(tsvname):
+    index = load_index(tsvname)
+    if index is None:
+        print('indexing',tsvname)
+        index = build_index(tsvname)
+        try:
+            save_index(index,tsvname)
+        except (IOError,OSError):
+            print('could not save index to',index_name(tsvname))
+    return index
+
+#byte offset at which each read block ends
+def block_ends(index):
+    return np.append(index['block_start'][1:],index['data_size'])
+
+#split the file into nshards byte ranges with roughly equal numbers of rows, cutting only between read blocks
+def shard_ranges(index,nshards):
+    starts,rows = index['block_start'],index['block_rows']
+    if len(starts) == 0:
+        return []
+    cumrows = np.cumsum(rows)
+    targets = cumrows[-1]*np.arange(1,nshards)/float(nshards)
+    cuts = np.unique(np.searchsorted(cumrows,targets,side='right'))
+    cuts = [cut for cut in cuts if 0 < cut < len(starts)]
+    bounds = [0]+cuts+[len(starts)]
+    ends = block_ends(index)
+    return [(int(starts[i]),int(ends[j-1])) for i,j in zip(bounds[:-1],bounds[1:])]
+
+#many small shards let a pool of processes pull work as they finish, so skewed data (high-coverage contigs, many short reads) keeps all cores busy.
+#shards are also the unit of checkpointing, so even a single process works through shards of at most MAX_SHARD_ROWS rows
+SHARDS_PER_PROCESS = 16
+MAX_SHARD_ROWS = 1000000
+
+def count_shards(index,nprocs):
+    total_rows = int(index['block_rows'].sum())
+    if nprocs == 1:
+        return max(1,-(-total_rows//MAX_SHARD_ROWS))
+    return max(nprocs*SHARDS_PER_PROCESS,-(-total_rows//MAX_SHARD_ROWS))
+
+#input from a pipe (- for stdin, or a named fifo) cannot be indexed or read more than once, and a gzip (rather than BGZF)
+#compressed tsv can only be decompressed from start to end, so each is read once by one process
+def is_stream(tsvname):
+    return tsvname == '-' or stat.S_ISFIFO(os.stat(tsvname).st_mode) or not is_splittable(tsvname)
+
+#read a streamed tsv once and yield numbered chunks of about chunk_rows rows that only end between read blocks.
+#gzip compressed input is decompressed as it is read
+def stream_chunks(tsvname,chunk_rows=MAX_SHARD_ROWS//10):
+    if tsvname == '-' or stat.S_ISFIFO(os.stat(tsvname).st_mode):
+        source = sys.stdin.buffer if tsvname == '-' else open(tsvname,'rb')
+        tsv = source
+        if source.peek(2)[:2] == GZIP_MAGIC:
+            import gzip
+            tsv = gzip.GzipFile(fileobj=source,mode='rb')
+    else:
+        source = tsv = open_input(tsvname)
+    chunk,rows,last_key,chunknum = [],0,None,0
+    for line in tsv:
+        if last_key is None and line.startswith(b'contig\t'):
+            continue
+        fields = line.split(b'\t',4)
+        key = (fields[0],fields[3])
+        if key != last_key:
+            if rows >= chunk_rows:
+                yield chunknum,b''.join(chunk)
+                chunk,rows = [],0
+                chunknum += 1
+            last_key = key
+        chunk.append(line)
+        rows += 1
+    if chunk:
+        yield chunknum,b''.join(chunk)
+    if tsv is not source:
+        tsv.close()
+    if source is not sys.stdin.buffer:
+        source.close()
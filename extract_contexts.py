@@ -1,10 +1,17 @@
 from collections import defaultdict
-from Bio import SeqIO
 import numpy as np
 import pickle 
 import sys
+import os
 import re
 
+from parse_eventalign import read_chunks,ChunkFields
+from reference_index import fetch_contig,ContigCache
+from read_qual import read_ids
+from block_features import block_observations
+from numpy_model import weights_name,is_weights_file,load_weights
+from run_report import StageTimer
+
 base_comps = {'A':'T','C':'G','T':'A','G':'C','N':'N','M':'M'}
 
 def comp(seq,base_comps=base_comps):
@@ -22,48 +29,80 @@ def strand(rev):
    else:
       return '+'
 
-#find positions of motifs (eg. CG bases) in reference sequence and change to M
+#start of every non-overlapping occurrence of motif in seq, scanning left to right as str.replace does
+def motif_starts(ref_seq,motif):
+   seq = np.frombuffer(ref_seq.encode(),dtype=np.uint8)
+   n = len(seq)-len(motif)+1
+   if n <= 0:
+      return np.zeros(0,dtype=np.int64)
+   match = np.ones(n,dtype=bool)
+   for i,nt in enumerate(motif.encode()):
+      match &= seq[i:i+n] == nt
+   starts = np.flatnonzero(match)
+   if any(motif[i:] == motif[:len(motif)-i] for i in range(1,len(motif))): #motif can overlap itself
+      kept,last_end = [],0
+      for start in starts.tolist():
+         if start >= last_end:
+            kept.append(start)
+            last_end = start+len(motif)
+      starts = np.array(kept,dtype=np.int64)
+   return starts
+
+#find positions of motifs (eg. CG bases) in reference sequence, returned as sorted 0-based positions of the methylated bases
 def methylate_motifs(ref_seq,motif,meth_base,meth_position=None): #TODO: add option to specify which A in motif with multiple A's 
    #print(motif, meth_base, meth_position)
    if meth_position:
-      meth_motif = motif[:meth_position]+'M'
-      if meth_position < len(motif)-1:
-         meth_motif = meth_position+motif[meth_position+1:]
+      offsets = [meth_position]
    else:
-      meth_motif = 'M'.join(motif.split(meth_base))
-   meth_seq = ref_seq.replace(motif,meth_motif)
-   #ref_motif_segs = ref_seq.split(motif)
-   #meth_seq = meth_motif.join(ref_motif_segs)
-   #print(len(meth_seq.split(meth_motif))-1, motif+' positions found')
-   return meth_seq
-
-#change specified positions to M in reference sequence
+      offsets = [i for i,nt in enumerate(motif) if nt == meth_base]
+   sites = (motif_starts(ref_seq,motif)[:,None]+np.array(offsets,dtype=np.int64)).ravel()
+   #print(len(sites), motif+' positions found')
+   return np.unique(sites)
+
+#check specified (1-based) positions are the methylated base in the reference sequence, returned as sorted 0-based positions
 def methylate_positions(ref_seq,positions,meth_base):
-   meth_seq = ref_seq
-   #print('next sequence')
-   count = 0
-   for pos in positions:
-      #print(meth_seq[pos-6:pos+5])
-      if meth_seq[pos-1] == meth_base:
-         meth_seq = meth_seq[:pos-1]+'M'+meth_seq[pos:]
-         count+=1
-         #print(meth_seq[pos-6:pos+5])
-      else:
-         print(count, meth_seq[pos-6:pos+5])
-         print('bad methylation')
-         sys.exit(0)
-   return meth_seq
+   sites = np.unique(np.array(positions,dtype=np.int64))-1
+   seq = np.frombuffer(ref_seq.encode(),dtype=np.uint8)
+   bad = (sites < 0) | (sites >= len(seq))
+   bad[~bad] = seq[sites[~bad]] != ord(meth_base)
+   if bad.any():
+      pos = int(sites[bad][0])+1
+      print(int(np.argmax(bad)), ref_seq[max(pos-6,0):pos+5])
+      print('bad methylation')
+      sys.exit(0)
+   return sites
+
+#keep recently methylated contigs, parsed positions files and loaded model so that a process handling many shards only prepares them once
+prepared_contigs = ContigCache()
+loaded_positions = {}
+loaded_models = {}
+
+#read a positions file (chromosome, position, strand[, label]) once into sorted 1-based positions for each contig and strand
+def load_positions(positions):
+   if positions not in loaded_positions:
+      table = np.loadtxt(positions,dtype=str,usecols=(0,1,2),ndmin=2,comments=None)
+      contigs,strands,pos = table[:,0],table[:,2],table[:,1].astype(np.int64)
+      order = np.lexsort((pos,strands,contigs))
+      contigs,strands,pos = contigs[order],strands[order],pos[order]
+      bounds = np.flatnonzero((contigs[1:] != contigs[:-1]) | (strands[1:] != strands[:-1]))+1
+      by_contig = defaultdict(dict)
+      for first,last in zip(np.append(0,bounds),np.append(bounds,len(pos))) if len(pos) else []:
+         by_contig[contigs[first]][strands[first]] = pos[first:last]
+      loaded_positions[positions] = by_contig
+      print(len(pos),'positions on',len(by_contig),'contigs')
+   return loaded_positions[positions]
 
 #extract signals around methylated positions from tsv
-def methylate_references(ref_seq,base,motif=None,positions=None,train=False):
+def methylate_references(ref_seq,base,motif=None,positions=None,train=False,contig=None):
    #print('sequence length', len(ref_seq))
    if motif:
       meth_fwd = methylate_motifs(ref_seq,motif,base)
       meth_rev = methylate_motifs(ref_seq,revcomp(motif),base_comps[base])
-      #print(len(meth_fwd.split('M')),'Ms in methylated sequence')
+      #print(len(meth_fwd),'methylated positions in sequence')
    elif positions:
-      fwd_pos = [int(pos.split()[1]) for pos in open(positions,'r').read().split('\n') if len(pos.split()) > 1 and pos.split()[2] == '+']
-      rev_pos = [int(pos.split()[1]) for pos in open(positions,'r').read().split('\n') if len(pos.split()) > 1 and pos.split()[2] == '-']
+      contig_pos = load_positions(positions).get(contig,{})
+      fwd_pos = contig_pos.get('+',[])
+      rev_pos = contig_pos.get('-',[])
       meth_fwd = methylate_positions(ref_seq,fwd_pos,base)
       meth_rev = methylate_positions(ref_seq,rev_pos,base_comps[base])
    else:  
@@ -71,152 +110,294 @@ def methylate_references(ref_seq,base,motif=None,positions=None,train=False):
       sys.exit(0)
    return meth_fwd,meth_rev
 
+#write M at the methylated positions in seq[start:end], as in the contexts reported for each observation
+def mark_sites(ref_seq,sites,start,end):
+   region = ref_seq[start:end]
+   if start < 0 or not region:
+      return region
+   region = list(region)
+   for site in sites[np.searchsorted(sites,start):np.searchsorted(sites,start+len(region))].tolist():
+      region[site-start] = 'M'
+   return ''.join(region)
+
+#returns the contig sequence with the sorted methylated positions on the forward and reverse strands
 def find_and_methylate(refname,contigname,base,motif,positions_list):
-    for ref in SeqIO.parse(refname,"fasta"):
-        contigid = ref.id
-        if contigid == contigname:
-            #print('contig =',contigid)
-            meth_fwd,meth_rev = methylate_references(str(ref.seq).upper(),base,motif=motif,positions=positions_list)
-            return meth_fwd,meth_rev
+    key = (refname,contigname,base,motif,positions_list)
+    prepared = prepared_contigs.get(key)
+    if prepared is None:
+        ref_seq = fetch_contig(refname,contigname)
+        if ref_seq is None:
+            return None
+        #print('contig =',contigname)
+        meth_fwd,meth_rev = methylate_references(ref_seq,base,motif=motif,positions=positions_list,contig=contigname)
+        prepared = (ref_seq,meth_fwd,meth_rev)
+        prepared_contigs.put(key,prepared,len(ref_seq)+meth_fwd.nbytes+meth_rev.nbytes)
+    return prepared
+
+#a weights file (given directly, or saved next to a pickled model and at least as new) is run with numpy alone;
+#otherwise the pickled scikit-learn model is loaded
+def load_model(modelfile):
+    if modelfile not in loaded_models:
+        weightsfile = weights_name(modelfile)
+        if is_weights_file(modelfile):
+            loaded_models[modelfile] = load_weights(modelfile)
+        elif os.path.isfile(weightsfile) and os.path.getmtime(weightsfile) >= os.path.getmtime(modelfile):
+            loaded_models[modelfile] = load_weights(weightsfile)
+        else:
+            modfi = open(modelfile,'rb')
+            loaded_models[modelfile] = pickle.load(modfi, encoding='bytes')
+            modfi.close()
+    return loaded_models[modelfile]
+
+#distance from each position to the next methylated site at or after it (k if there is none within the kmer)
+def next_site_offsets(sites,positions,k):
+    idx = np.searchsorted(sites,positions)
+    offsets = np.full(len(positions),k,dtype=np.int64)
+    found = idx < len(sites)
+    offsets[found] = np.minimum(sites[idx[found]]-positions[found],k)
+    return offsets
+
+#read blocks of the tsv as (contig, (sequence, forward sites, reverse sites), columns), where columns holds the position,
+#reference kmer, read id, event index, model kmer, event - model current and offsets of the next forward and reverse sites
+#for each row. rows with a site on either strand within their kmer are kept, as is the first row after them in the same
+#read block since it ends the observation; every other row, and rows of reads under the quality threshold, are dropped
+#before any per-row python work. rows and the rows dropped for each reason are counted in the timer's parsing stage
+def iter_site_blocks(chunks,load_contig,read_table,k,qual_thresh=0,timer=None):
+    read_names,read_quals = read_table
+    if timer is None:
+        timer = StageTimer()
+    block,last_key = 0,None
+    carry_block,carry_near = -1,False
+    pending = None
+    for chunk in chunks:
+        #only the columns that decide which rows are kept are converted for every row
+        fields = ChunkFields(chunk)
+        if fields.nrows == 0:
+            continue
+        contigs,names,positions = fields.column('contig'),fields.column('read_name'),fields.column('position')
+        new_contig = np.append(True,contigs[1:] != contigs[:-1])
+        new_block = new_contig | np.append(True,names[1:] != names[:-1])
+        if last_key == (contigs[0],names[0]):
+            new_block[0] = False
+        last_key = (contigs[-1],names[-1])
+        blocks = block+np.cumsum(new_block)
+        block = int(blocks[-1])
+
+        fwd_offsets = np.full(len(positions),k,dtype=np.int64)
+        rev_offsets = np.full(len(positions),k,dtype=np.int64)
+        contig_starts = np.flatnonzero(new_contig)
+        refs = [None]*len(contig_starts)
+        for i,(cstart,cend) in enumerate(zip(contig_starts,np.append(contig_starts[1:],len(contigs)))):
+            refs[i] = load_contig(contigs[cstart].decode())
+            if refs[i] is not None:
+                fwd_offsets[cstart:cend] = next_site_offsets(refs[i][1],positions[cstart:cend],k)
+                rev_offsets[cstart:cend] = next_site_offsets(refs[i][2],positions[cstart:cend],k)
+        near = (fwd_offsets < k) | (rev_offsets < k)
+        ids = read_ids(names,read_names)
+        model_kmers = fields.column('model_kmer')
+        modelled = model_kmers != 'NNNNNN'
+        low_quality = read_quals[ids] < qual_thresh
+        passing = np.flatnonzero(modelled & ~low_quality)
+        after_near = np.zeros(len(positions),dtype=bool)
+        after_near[passing[1:]] = near[passing[:-1]] & (blocks[passing[1:]] == blocks[passing[:-1]])
+        if len(passing):
+            after_near[passing[0]] = carry_near and blocks[passing[0]] == carry_block
+            carry_block,carry_near = blocks[passing[-1]],near[passing[-1]]
+        keep = np.zeros(len(positions),dtype=bool)
+        keep[passing] = near[passing] | after_near[passing]
+        keep = np.flatnonzero(keep)
+        timer.count('parsing',chunks=1,bytes=len(chunk),rows=len(positions),rows_kept=len(keep),rows_no_model=int((~modelled).sum()),
+                    rows_low_quality=int((modelled & low_quality).sum()),rows_off_site=len(passing)-len(keep))
+
+        kept = {'position':positions[keep],'reference_kmer':fields.column('reference_kmer',keep),'read_id':ids[keep],
+                'event_index':fields.column('event_index',keep),'model_kmer':model_kmers[keep],
+                'event_diff':fields.column('event_level_mean',keep)-fields.column('model_mean',keep),
+                'fwd_offset':fwd_offsets[keep],'rev_offset':rev_offsets[keep]}
+        kept_blocks,kept_refs = blocks[keep],(np.cumsum(new_contig)-1)[keep]
+        bounds = np.flatnonzero(kept_blocks[1:] != kept_blocks[:-1])+1
+        #the last block of a chunk may continue in the next one
+        for first,last in zip(np.append(0,bounds),np.append(bounds,len(keep))) if len(keep) else []:
+            rows = {name:column[first:last] for name,column in kept.items()}
+            if pending is not None and pending[0] == kept_blocks[first]:
+                pending[3] = {name:np.concatenate((pending[3][name],rows[name])) for name in rows}
+                continue
+            if pending is not None:
+                yield tuple(pending[1:])
+            pending = [kept_blocks[first],contigs[keep[first]].decode(),refs[kept_refs[first]],rows]
+    if pending is not None:
+        yield tuple(pending[1:])
+
+#training observations are kept as float32 feature rows with a label code (index in the sorted labels) and a context id
+def training_dtype(k):
+    return np.dtype([('features',np.float32,(k+1,)),('label',np.uint8),('context',np.int64)])
+
+def label_names(pos_label):
+    return sorted(set(pos_label.values()))
+
+#contexts read as base-6 numbers, so every process gives the same context the same id
+context_digits = str.maketrans('ACGTMN','012345')
+
+def context_id(context):
+    return int(context.translate(context_digits),6)
+
+#name of the diffs file written for a given tsv (without any .gz or .bgz extension)
+def diffs_name(tsv_input,k,train=False):
+    tsv_input = re.sub(r'\.b?gz$','',tsv_input)
+    if not train:
+        return '.'.join(tsv_input.split('.')[:-1])+'.diffs.'+str(k)
+    else:
+        return '.'.join(tsv_input.split('.')[:-1])+'.diffs.'+str(k)+'.train'
 
 #determine difference between measurements and model for bases surrounding methylated positions 
-def extract_features(tsv_input,fasta_input,read2qual,k,skip_thresh,qual_thresh,modelfile,classifier,startline,endline=None,train=False,pos_label=None,chrom=None,meth_fwd=None,meth_rev=None,base=None,motif=None,positions_list=None):
-    #def extract_features(tsv_input,read2qual,contigid,meth_fwd,meth_rev,k,skip_thresh,qual_thresh,modelfile,classifier,startline,endline=None,train=False,pos_label=None):
-    #set position variables
-    firstline,last_read,last_pos,last_pos_in_kmer,linenum,last_read_num = True,'',0,k,0,0
-    last_contig = chrom
+#reads the byte range [start,end) of the tsv, which should begin and end on read block boundaries (see eventalign_index.py),
+#or the given chunks of whole read blocks when streaming. the time and counts of each stage are added to timer, if given
+def extract_features(tsv_input,fasta_input,read_table,k,skip_thresh,qual_thresh,modelfile,classifier,start,end=None,train=False,pos_label=None,chrom=None,ref_sites=None,base=None,motif=None,positions_list=None,batch_size=4096,outfi=None,chunks=None,engine='loop',timer=None):
+    #reads are handled by their id in the sorted read table (see read_qual.py), names are only looked up for output
+    read_names,read_quals = read_table
+    last_read_num = 0
+    missing_contigs = set()
     #set count variables 
     num_observations,w_skips,skipped_skips,pos_set,multi_meth_pos_set,read_set = 0,set(),set(),set(),set(),set()
-    #set tracking variables for observation
-    mpos = None
-    diff_col = [[] for xi in range(k)]
+    last_info = None
+    if timer is None:
+        timer = StageTimer()
+
+    #write to the given buffered output, or append to the default diffs file if used on its own
+    close_output = outfi is None
+    if close_output:
+        outfi = open(diffs_name(tsv_input,k,train),'a')
 
     if not train:
-        tsv_output = '.'.join(tsv_input.split('.')[:-1])+'.diffs.'+str(k)
-        modfi = open(modelfile,'rb')
-        model = pickle.load(modfi, encoding='bytes')
-        modfi.close()
+        with timer.stage('classification'):
+            model = load_model(modelfile)
+        #observations wait in a fixed-size buffer so the classifier runs on many rows per call
+        batch = np.empty((batch_size,k+1))
+        batch_lines = []
     else:
-        tsv_output = '.'.join(tsv_input.split('.')[:-1])+'.diffs.'+str(k)+'.train'
         signals,labels,contexts = [],[],[]
+        label_codes = {label:code for code,label in enumerate(label_names(pos_label))}
+
+    #classify the buffered observations and write them out in the order they were seen
+    def classify_batch():
+        if not batch_lines:
+            return
+        with timer.stage('classification'):
+            mod_probs = model.predict_proba(batch[:len(batch_lines)])[:,1]
+            for line,mod_prob in zip(batch_lines,mod_probs):
+                if mod_prob >= 0.5: 
+                    label = 'm6A' #TODO: ensure correct direction + label unmeth/meth as appropriate 
+                else:
+                    label = 'A' 
+                outfi.write('%s%s\t%.2f\n' % (line,label,mod_prob))
+            timer.count('classification',batches=1,observations=len(batch_lines),methylated=int((mod_probs >= 0.5).sum()))
+            del batch_lines[:]
+
+    #save the observation for a methylated position (mpos) given the mean difference at each kmer position (0 if skipped)
+    def save_observation(read_id,chrom,ref,mpos,rev,diffs,num_skips):
+        nonlocal num_observations,last_read_num,last_info
+        if num_skips <= skip_thresh: #accept max number of skips within an observation
+            if num_skips> 0:
+                w_skips.add((read_id,mpos))
+            if not rev:
+                diffs = diffs[::-1]
+            diffs = diffs+[read_quals[read_id]]
+            context = revcomp(mark_sites(ref[0],ref[2] if rev else ref[1],mpos-k+1,mpos+k),rev)
+            last_info = read_names[read_id].decode()+'\t'+str(mpos)+'\t'+context+'\t'+','.join(['%.4f' % diff for diff in diffs])+'\t'+strand(rev)
+            line = chrom+'\t'+last_info+'\t'
+            if not train:
+                batch[len(batch_lines)] = diffs
+                batch_lines.append(line)
+                if len(batch_lines) == batch_size:
+                    classify_batch()
+            else:
+                label = pos_label[(chrom,mpos,strand(rev))]
+                signals.append(diffs)
+                labels.append(label_codes[label])
+                contexts.append(context_id(context))
+                outfi.write(line+label+'\n')
+            num_observations += 1
+            pos_set.add(mpos)
+            read_set.add(read_id)
+            if len(read_set)%1000 == 0 and len(read_set) > last_read_num:
+                print(len(read_set), 'reads examined')
+                last_read_num = len(read_set)
+        else:
+            skipped_skips.add((read_id,mpos))
 
     #save only one set of adjoining methylated positions at a time - once the set complete, write the positions to a file 
     #tsv format: ecoli   805 CGCCAT  cc1da58e-3db3-4a4b-93c2-c78e1dbe6aba:1D_000:template    t   1   102.16  0.963   0.00175 CGCCAT  102.23  1.93    -0.03   101.973,100.037,102.403,101.758,104.338,102.618,101.973
-    with open(tsv_input,'r') as tsv:
-        for line in tsv:
-            if (startline==0 and linenum==0) or (linenum<startline-1):
-                firstline = False
-                linenum+=1
-                continue
-            if endline and not mpos and linenum > endline:
-                break
-            linenum+=1
-            chrom, read_pos, read_kmer, read_name, x, read_ind, event_current, event_sd, y, ref_kmer, model_current, ref_sd, z, all_current_values  = line.split('\t')
-            if chrom != last_contig:
-                #print('loading new contig',chrom)
-                try:
-                    meth_fwd,meth_rev = find_and_methylate(fasta_input,chrom,base,motif,positions_list)
-                    print('finished loading.',len(meth_fwd.split('M')),'positions to examine' )
-                    last_contig = chrom
-                except ValueError:
-                    print('Error: could not find sequence for reference contig',chrom)
-                    continue
-            if read_name != last_read:
-                first_read_ind = int(read_ind) 
-            if (read2qual[read_name] < qual_thresh) or ref_kmer == 'NNNNNN':
-                continue
-            if (read_name != last_read and read_kmer == ref_kmer) or (read_name == last_read and int(read_ind) > first_read_ind): #takes into account complementary palindromes
+    #each read block is handled independently so that results do not depend on where the file is split
+    def loop_block(chrom,ref,rows):
+        nonlocal last_info
+        #set position variables
+        last_read,last_pos,last_pos_in_kmer = -1,0,k
+        #set tracking variables for observation
+        mpos = None
+        diff_col = [[] for xi in range(k)]
+
+        def save_diff_col():
+            num_skips = len([x for x in diff_col if x == []])
+            diffs = [np.mean(kmer_pos) if kmer_pos!=[] else 0 for kmer_pos in diff_col]
+            save_observation(last_read,chrom,ref,mpos,last_rev,diffs,num_skips)
+
+        for read_pos, read_kmer, read_id, read_ind, ref_kmer, event_diff, fwd_offset, rev_offset in zip(*[rows[name].tolist() for name in
+                ['position','reference_kmer','read_id','event_index','model_kmer','event_diff','fwd_offset','rev_offset']]):
+            if read_id != last_read:
+                first_read_ind = read_ind
+            if (read_id != last_read and read_kmer == ref_kmer) or (read_id == last_read and read_ind > first_read_ind): #takes into account complementary palindromes
                 rev = False
-                meth_ref = meth_fwd
+                site_offset = fwd_offset
             else:
                 rev = True
-                meth_ref = meth_rev
-            read_pos = int(read_pos)
-            reference_kmer = meth_ref[read_pos:read_pos+k]
-            #print(read_name,rev,ref_kmer,reference_kmer)
+                site_offset = rev_offset
+            #print(read_id,rev,ref_kmer,site_offset)
 
             #if finished context for previous potentially modified position, save and reset
-            if mpos and ((read_pos >= mpos+1 and read_name == last_read) or (read_name != last_read)):
-     
-                #write to file
-                num_skips = len([x for x in diff_col if x == []])
-                if num_skips <= skip_thresh: #accept max number of skips within an observation
-                    if num_skips> 0:
-                        w_skips.add((last_read,mpos))
-                    with open(tsv_output,'a') as outfi:
-                        diffs = [np.mean(kmer_pos) if kmer_pos!=[] else 0 for kmer_pos in diff_col]
-                        if not last_rev:
-                            diffs = diffs[::-1]
-                        diffs = diffs+[read2qual[last_read]]
-                        context = revcomp(meth_ref[mpos-k+1:mpos+k],last_rev)
-                        if not train:
-                            mod_prob = model.predict_proba([diffs])
-                            if mod_prob[0][1] >= 0.5: 
-                                label = 'm6A' #TODO: ensure correct direction + load model in advance + label unmeth/meth as appropriate 
-                            else:
-                                label = 'A' 
-                            label = label+'\t'+str(np.round(mod_prob[0][1],2))
-                        else:
-                            mod_prob = ''
-                            label = pos_label[(mpos,strand(last_rev))] #TODO: add chromosome?
-                            signals.append(diffs)
-                            labels.append(label)
-                            contexts.append(context)
-                        outfi.write(chrom+'\t'+last_read+'\t'+str(mpos)+'\t'+context+'\t'+','.join([str(diff) for diff in diffs])+'\t'+strand(last_rev)+'\t'+label+'\n')
-                        last_info = last_read+'\t'+str(mpos)+'\t'+context+'\t'+','.join([str(diff) for diff in diffs])+'\t'+strand(last_rev)+'\t'+label
-                    num_observations += 1
-                    pos_set.add(mpos)
-                    read_set.add(last_read)
-                    if len(read_set)%1000 == 0 and len(read_set) > last_read_num:
-                        print(len(read_set), 'reads examined')
-                        last_read_num = len(read_set)
-                else:
-                    skipped_skips.add((last_read,mpos))
-       
+            if mpos and ((read_pos >= mpos+1 and read_id == last_read) or (read_id != last_read)):
+         
+                save_diff_col()
+           
                 #reset variables
-                if len(reference_kmer.split('M')) < 2 or read_name != last_read or read_pos > mpos+skip_thresh+1: #allow no more than skip_thresh skips
+                if site_offset >= k or read_id != last_read or read_pos > mpos+skip_thresh+1: #allow no more than skip_thresh skips
                     diff_col = [[] for i in range(k)] 
                     mpos = None
                     last_pos_in_kmer = k 
                 else: 
-                    if reference_kmer[0] != 'M':
+                    if site_offset != 0:
                         multi_meth_pos_set.add((last_read,mpos))
                     last_mpos = mpos
-                    pos_in_kmer = len(reference_kmer.split('M')[0])
+                    pos_in_kmer = site_offset
                     mpos = read_pos + pos_in_kmer
                     mspacing = mpos - last_mpos
                     last_pos_in_kmer = pos_in_kmer
                     diffs = [[] for i in range(mspacing)] + diff_col[:-mspacing]
                     diff_col = diffs
                     if len(diff_col) != k:
-                        try:
+                        if last_info:
                             print(last_info)
-                        except:
-                            pass
-                        print(reference_kmer,mpos,read_pos,read_pos>mpos,read_name,last_read,diff_col,mspacing)
+                        print(site_offset,mpos,read_pos,read_pos>mpos,read_id,last_read,diff_col,mspacing)
                         diff_col = [[] for i in range(k)]
                         #break
 
             #if modified base in reference, save surrounding context to call that position
-            #if len([x for x in reference_kmer if x == 'M']) >= 1:
-            if 'M' in set(list(reference_kmer)):
-                pos_in_kmer = [i for i,x in enumerate(list(reference_kmer)) if x == 'M'][0]
+            if site_offset < k:
+                pos_in_kmer = site_offset
                 #if new read, reset differences variable and proceed
-                if mpos and read_name != last_read:
+                if mpos and read_id != last_read:
                     mpos = None
                     diff_col = [[] for i in range(k)]
                 #if new read or new position
                 if not mpos: #TODO: reject any positions too close to beginning of read automatically
                     mpos = read_pos+pos_in_kmer
                 last_pos_in_kmer = pos_in_kmer
-                last_read = read_name
+                last_read = read_id
                 last_rev = rev
                 try:
-                    diff_col[pos_in_kmer].append(float(event_current)-float(model_current))
+                    diff_col[pos_in_kmer].append(event_diff)
                 except IndexError:
-                    print(diff_col, mpos, read_pos, reference_kmer, pos_in_kmer)
+                    print(diff_col, mpos, read_pos, site_offset, pos_in_kmer)
                     diff_col = [[] for i in range(k)]
-                    diff_col[pos_in_kmer].append(float(event_current)-float(model_current))
+                    diff_col[pos_in_kmer].append(event_diff)
                     #break
                 last_pos = read_pos 
                 #print(mpos, reference_kmer, read_pos, diff_col)
@@ -225,6 +406,61 @@ def extract_features(tsv_input,fasta_input,read2qual,k,skip_thresh,qual_thresh,m
                 mpos = None
                 diff_col = [[] for i in range(k)]
 
+        #the last observation is complete once the read block ends
+        if mpos:
+            save_diff_col()
+
+    #whole read blocks at once with array operations, or through the loop above if the block does not suit them
+    def vectorized_block(chrom,ref,rows):
+        observations = block_observations(rows,k,skip_thresh)
+        if observations is None:
+            loop_block(chrom,ref,rows)
+            return
+        read_id = int(rows['read_id'][0])
+        rev,mpos,means,num_skips,multi_meth = observations
+        for last_mpos in multi_meth:
+            multi_meth_pos_set.add((read_id,last_mpos))
+        for site,diffs,skips in zip(mpos,means,num_skips):
+            save_observation(read_id,chrom,ref,site,rev,diffs,skips)
+
+    #sequence and methylated sites for a contig, or None (and rows dropped) if the contig is not in the reference
+    def load_contig(contig):
+        if ref_sites is not None and contig == chrom:
+            return ref_sites
+        if contig in missing_contigs:
+            return None
+        #print('loading new contig',contig)
+        with timer.stage('reference_marking'):
+            ref = find_and_methylate(fasta_input,contig,base,motif,positions_list)
+        if ref is None:
+            print('Error: could not find sequence for reference contig',contig)
+            missing_contigs.add(contig)
+            timer.count('reference_marking',contigs_missing=1)
+        else:
+            print('finished loading.',len(ref[1])+len(ref[2]),'positions to examine' )
+            timer.count('reference_marking',contigs=1,sites=len(ref[1])+len(ref[2]))
+        return ref
+
+    if engine == 'block':
+        process_block = vectorized_block
+    else:
+        process_block = loop_block
+    if chunks is None:
+        chunks = read_chunks(tsv_input,start,end)
+    #time spent producing each read block is parsing, and what is done with it feature assembly
+    num_blocks = 0
+    for block_chrom,ref,rows in timer.iterate('parsing',iter_site_blocks(chunks,load_contig,read_table,k,qual_thresh,timer)):
+        with timer.stage('feature_assembly'):
+            process_block(block_chrom,ref,rows)
+        num_blocks += 1
+
+    if not train:
+        classify_batch()
+    if close_output:
+        outfi.close()
+    timer.count('feature_assembly',read_blocks=num_blocks,reads=len(read_set),observations=num_observations,observations_with_skips=len(w_skips),
+                observations_too_many_skips=len(skipped_skips),multi_site_regions=len(multi_meth_pos_set))
+
     print('thread finished processing...')
     print(num_observations,'observations')
     num_pos = len(pos_set)
@@ -234,5 +470,9 @@ def extract_features(tsv_input,fasta_input,read2qual,k,skip_thresh,qual_thresh,m
     print(len(w_skips), 'observations with skips included')
     print(len(skipped_skips), 'observations with too many skips')
     if train:
-        return signals, labels, contexts
-
+        records = np.empty(len(signals),dtype=training_dtype(k))
+        if len(signals):
+            records['features'] = signals
+            records['label'] = labels
+            records['context'] = contexts
+        return records
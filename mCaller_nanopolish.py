@@ -2,121 +2,285 @@
 #A program to classify bases as methylated or unmethylated based on long-range signals using the output from nanopolish
 #Alexa McIntyre, 2016-2017
 
-from collections import defaultdict
+from collections import deque
 import numpy as np
-import pickle 
 import sys
 #import time
 import os
-import math
 import multiprocessing
-from Bio import SeqIO
+import io
 
 from extract_contexts import *
-from train_model import train_classifier,pos2label
-from read_qual import extract_read_quality
+from eventalign_index import get_index,shard_ranges,count_shards,is_stream,stream_chunks
+from merge_diffs import sort_lines,merge_spans
+from diffs_index import tbi_name
+from bgzf import gzi_name
+from read_qual import extract_read_quality,share_read_table,attach_read_table
+from reference_index import get_fai
+from checkpoint import worker_part_name,journal_name,save_plan,load_plan,record_shard,load_checkpoints,clear_checkpoints
+from run_report import StageTimer,write_report
+from profiling import clear_profiles,start_profile,profile_settings,profiled,memory_snapshot,summarize_profiles
 
-def distribute_threads(positions_list,motif,tsvname,read2qual,refname,num_refs,base,mod,nprocs,nvariables,train,modelfile,skip_thresh,qual_thresh,classifier):
+#extract_features arguments shared by every shard and the worker's output file, set once in each worker process
+shard_settings = {}
+worker_output = {}
+shared_blocks = []
+
+#each worker keeps one buffered output file open for all of its shards, opened when it gets its first shard, with a new
+#name if an interrupted run left a file with the same process id. the read table is either given directly or attached from shared memory.
+#with --profile, each worker profiles the shards it processes
+def init_worker(settings,tsv_output,shared_table=None,profile=None):
+    if profile is not None:
+        start_profile(role='worker',**profile)
+    shard_settings.update(settings)
+    if shared_table is not None:
+        read_table,blocks = attach_read_table(shared_table)
+        shard_settings['read_table'] = read_table
+        shared_blocks.extend(blocks)
+    worker_output['name'] = worker_part_name(tsv_output,os.getpid())
+
+#returns the shard number, where the shard's training records are in the worker's training file (if training),
+#where the shard's sorted lines are in the worker's output file, and the time and counts of each stage for the shard
+def process_shard(shard):
+    i,(start,end) = shard
+    timer = StageTimer()
+    with profiled():
+        result = run_shard(i,timer,start=start,end=end)
+        #once the shard is on disk, note it in the worker's journal so an interrupted run can resume after it
+        with timer.stage('output'):
+            if 'ckpt' not in worker_output:
+                worker_output['ckpt'] = open(journal_name(worker_output['name']),'a')
+            record_shard(worker_output['ckpt'],[worker_output[name] for name in ['part','train'] if name in worker_output],i,start,end,result[1],result[2])
+    return result+(timer.summary(),)
+
+#a chunk of whole read blocks sent by the process reading a streamed tsv
+def process_chunk(chunk):
+    i,data = chunk
+    timer = StageTimer()
+    with profiled():
+        result = run_shard(i,timer,start=0,chunks=[data])
+    return result+(timer.summary(),)
+
+def run_shard(i,timer,**shard_input):
+    if 'part' not in worker_output:
+        worker_output['part'] = open(worker_output['name'],'wb',buffering=1<<20)
+    outfi = worker_output['part']
+    shard_out = io.StringIO()
+    records = extract_features(outfi=shard_out,timer=timer,**dict(shard_settings,**shard_input))
+    with timer.stage('output'):
+        out_start = outfi.tell()
+        lines = sort_lines(shard_out.getvalue().encode().splitlines(True))
+        with timer.stage('profiling'):
+            memory_snapshot()
+        outfi.writelines(lines)
+        outfi.flush()
+        timer.count('output',lines=len(lines),bytes=outfi.tell()-out_start)
+        train_span = None
+        if records is not None:
+            #training records go to a file the parent maps, rather than back through the pool's pipe
+            if 'train' not in worker_output:
+                worker_output['train'] = open(worker_output['name']+'.train','wb',buffering=1<<20)
+            trainfi = worker_output['train']
+            train_span = (trainfi.name,trainfi.tell(),len(records))
+            trainfi.write(records.tobytes())
+            trainfi.flush()
+            timer.count('output',training_records=len(records))
+    return i,train_span,(outfi.name,out_start,outfi.tell())
+
+#like pool.imap, but only reads ahead max_pending tasks so a streamed input is never held in memory
+def bounded_imap(pool,func,tasks,max_pending):
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func,(task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+#copy the training records of every shard, in shard order, from the memory-mapped worker files into feature, label and
+#context arrays, then remove the worker files
+def gather_training(spans,k):
+    nobs = sum(span[2] for span in spans)
+    signals = np.empty((nobs,k+1),dtype=np.float32)
+    labels = np.empty(nobs,dtype=np.uint8)
+    contexts = np.empty(nobs,dtype=np.int64)
+    row = 0
+    for trainname,offset,count in spans:
+        if count:
+            records = np.memmap(trainname,dtype=training_dtype(k),mode='r',offset=offset,shape=(count,))
+            signals[row:row+count] = records['features']
+            labels[row:row+count] = records['label']
+            contexts[row:row+count] = records['context']
+            del records
+            row += count
+    for trainname in set(span[0] for span in spans):
+        os.remove(trainname)
+    return signals,labels,contexts
+
+#batches of training records read from the worker files, for training without holding every record in memory. the spans
+#are cut into batches of at most batch_rows records, which are visited in a random order with their rows shuffled
+def iter_training_batches(spans,k,batch_rows,rng):
+    dtype = training_dtype(k)
+    batches = [(trainname,offset+start*dtype.itemsize,min(batch_rows,count-start)) for trainname,offset,count in spans for start in range(0,count,batch_rows)]
+    for j in rng.permutation(len(batches)):
+        trainname,offset,count = batches[j]
+        records = np.fromfile(trainname,dtype=dtype,count=count,offset=offset)[rng.permutation(count)]
+        yield records['features'],records['label'],records['context']
+
+#merge the sorted shard outputs from the worker files into the final output (BGZF compressed and tabix indexed with
+#compress), then remove the checkpoints and worker files
+def merge_outputs(spans,tsv_output,compress=False):
+    merge_spans(spans,tsv_output,compress=compress)
+    clear_checkpoints(tsv_output)
+    for partname in set(span[0] for span in spans):
+        os.remove(partname)
+
+#remove the output, its indexes, checkpoints and worker files of an earlier run
+def clear_output(tsv_output):
+    for outname in [tsv_output,tbi_name(tsv_output),gzi_name(tsv_output)]:
+       try:
+          os.remove(outname)
+       except OSError:
+          pass
+    clear_checkpoints(tsv_output,parts_too=True)
+
+#the time and counts of each stage in this process go to timer, and with those of the workers to a JSON file if report is given
+def distribute_threads(positions_list,motif,tsvname,read_table,refname,base,mod,nprocs,nvariables,train,modelfile,skip_thresh,qual_thresh,classifier,batch_size=4096,tsv_output=None,engine='loop',resume=False,incremental=False,epochs=5,holdout=0.2,search=0,timer=None,report=None,compress=False):
     """ distributes list of genomic positions across processes then adds resulting signals to matrix if training"""
+    if timer is None:
+        timer = StageTimer()
+    if not tsv_output:
+        tsv_output = diffs_name(tsvname,nvariables,train)+('.gz' if compress else '')
     if not train:
-      tsv_output = '.'.join(tsvname.split('.')[:-1])+'.diffs.'+str(nvariables)
       training_pos_dict = None
     else: 
-      tsv_output = '.'.join(tsvname.split('.')[:-1])+'.diffs.'+str(nvariables)+'.train'
+      #scikit-learn is only imported for training, inference runs the exported weights or the pickled model
+      from train_model import train_classifier,train_incremental,TRAIN_BATCH_ROWS,pos2label
       training_pos_dict = pos2label(positions_list)
-    try:
-       os.remove(tsv_output)
-    except OSError:
-       pass
+    if resume and is_stream(tsvname):
+        raise ValueError('cannot resume a run reading a streamed or gzip (rather than bgzip) compressed tsv')
 
+    num_refs = len(get_fai(refname))
     print(num_refs, 'contigs')
     print(nprocs, 'threads')
 
-    if nprocs > 1:
-        nprocs_allocated = 0
-        procs = []
-        out_q = multiprocessing.Queue()
-        def worker(out_q,tsvname,fastaname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,startline,endline,train,training_pos_dict,contigid=None,meth_fwd=None,meth_rev=None,base=base,motif=None,positions_list=None): 
-            #extract_features(tsv_input,fasta_input,read2qual,k,skip_thresh,qual_thresh,modelfile,classifier,startline,endline=None,train=False,pos_label=None)
-            outtup = extract_features(tsvname,fastaname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,startline,endline=endline,train=train,pos_label=training_pos_dict,chrom=contigid,meth_fwd=meth_fwd,meth_rev=meth_rev,base=base,motif=motif,positions_list=positions_list)
-            out_q.put(outtup)
-        def countlines(filename,num_refs,contigid=None):
-            if num_refs == 0: #TODO: remove this
-                print(filename)
-                return sum(1 for _ in open(filename))
-            else:
-                contig_reached = False
-                contigstart = 1
-                contignum = 0
-                for line in open(filename):
-                    if line.split('\t')[0] == contigid:
-                        if not contig_reached:
-                            contig_reached = True
-                        contignum += 1
-                    elif not contig_reached:
-                        contigstart += 1
-                return contigstart,contignum
-
-    if nprocs == 1 or num_refs == 1:
-        for ref in SeqIO.parse(refname,"fasta"):
-            contigid = ref.id
+    with timer.stage('reference_marking'):
+        if positions_list:
+            #parse the positions file once here so that forked workers share it
+            load_positions(positions_list)
+        if num_refs == 1:
+            #single contig: mark methylated positions once and share with all processes
+            contigid = next(iter(get_fai(refname)))
             print('contig =',contigid,'- allocating',nprocs,'threads')
-            meth_fwd,meth_rev = methylate_references(str(ref.seq).upper(),base,motif=motif,positions=positions_list)
-            #sys.exit(0)
-
-            if nprocs == 1:   
-                if not train:
-                    extract_features(tsvname,refname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,0,chrom=contigid,meth_fwd=meth_fwd,meth_rev=meth_rev) #TODO: implement quality thresholding
-                else:
-                    signal_mat, label_array, context_array = extract_features(tsvname,refname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,0,train=train,pos_label=training_pos_dict,chrom=contigid,meth_fwd=meth_fwd,meth_rev=meth_rev)
+            ref_sites = find_and_methylate(refname,contigid,base,motif,positions_list)
+            if ref_sites is not None:
+                timer.count('reference_marking',contigs=1,sites=len(ref_sites[1])+len(ref_sites[2]))
+        else:
+            #multiple contigs: each process loads contigs as it reaches them in the tsv
+            contigid,ref_sites = None,None
+    if is_stream(tsvname):
+        #read the stream once in this process and hand whole read blocks to the workers
+        clear_output(tsv_output)
+        tasks = stream_chunks(tsvname)
+        func = process_chunk
+        done = {}
+    else:
+        #the shards of an interrupted run are reused, skipping those its workers finished
+        shards = load_plan(tsv_output,tsvname,nvariables,train) if resume else None
+        if shards is None:
+            if resume:
+                print('no checkpoint to resume from for',tsv_output)
+            clear_output(tsv_output)
+            index = get_index(tsvname)
+            shards = shard_ranges(index,count_shards(index,nprocs))
+            save_plan(tsv_output,tsvname,shards,nvariables,train)
+            done = {}
+        else:
+            done = load_checkpoints(tsv_output,training_dtype(nvariables).itemsize)
+            print('resuming:',len(done),'of',len(shards),'shards already done')
+        print(len(shards),'shards')
+        tasks = [(i,shard) for i,shard in enumerate(shards) if i not in done]
+        func = process_shard
 
+    settings = {'tsv_input':tsvname,'fasta_input':refname,'k':nvariables,'skip_thresh':skip_thresh,'qual_thresh':qual_thresh,
+                'modelfile':modelfile,'classifier':classifier,'train':train,'pos_label':training_pos_dict,'chrom':contigid,'ref_sites':ref_sites,
+                'base':base,'motif':motif,'positions_list':positions_list,'batch_size':batch_size,'engine':engine}
+    #a failing worker stops the pool, and the shared read table is always released
+    pool,blocks = None,[]
+    try:
+        if nprocs == 1:
+            init_worker(dict(settings,read_table=read_table),tsv_output,profile=profile_settings())
+            results = map(func,tasks)
+        else:
+            #workers pull shards off the queue as they finish, results are put back in file order for training.
+            #read names and qualities go in shared memory once instead of being copied to every worker
+            shared_table,blocks = share_read_table(*read_table)
+            pool = multiprocessing.Pool(nprocs,initializer=init_worker,initargs=(settings,tsv_output,shared_table,profile_settings()))
+            if func == process_chunk:
+                results = bounded_imap(pool,func,tasks,4*nprocs)
             else:
-                print(tsvname)
-                cstart, nlines = countlines(tsvname,num_refs,contigid) #TODO: split by reference sequence in or out of python? 
-                chunksize = int(math.ceil(nlines / float(nprocs)))
+                results = pool.imap_unordered(func,tasks)
 
-                for i in range(nprocs):
-                    p = multiprocessing.Process(
-                        target=worker,
-                        args=(out_q,tsvname,refname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,cstart+chunksize*i,cstart+chunksize*(i+1),train,training_pos_dict,contigid,meth_fwd,meth_rev))
-                    procs.append(p)
-                    p.start()
+        train_spans = {i:spans[0] for i,spans in done.items()}
+        shard_spans = {i:spans[1] for i,spans in done.items()}
+        shard_summaries = []
+        for i,train_span,span,summary in results:
+            train_spans[i] = train_span
+            shard_spans[i] = span
+            shard_summaries.append(summary)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for block in blocks:
+            block.close()
+            block.unlink()
+    train_spans = [train_spans[i] for i in sorted(train_spans)]
+    shard_spans = [shard_spans[i] for i in sorted(shard_spans)]
+    if nprocs == 1:
+        for name in ['part','train','ckpt']:
+            if name in worker_output:
+                worker_output.pop(name).close()
+    with timer.stage('output'):
+        merge_outputs(shard_spans,tsv_output,compress=compress)
+        timer.count('output',merged_bytes=os.path.getsize(tsv_output))
+
+    if train and not incremental:
+        # Collect all results into a signal matrix and an array of labels
+        with timer.stage('training'):
+            signal_mat,label_codes,context_array = gather_training(train_spans,nvariables)
+            label_array = np.array(label_names(training_pos_dict))[label_codes]
+            with timer.stage('profiling'):
+                memory_snapshot()
 
-    else:
-        nlines = countlines(tsvname,1)
-        chunksize = int(math.ceil(nlines / float(nprocs)))
-
-        for i in range(nprocs):
-            p = multiprocessing.Process(
-                    target=worker, 
-                    args=(out_q,tsvname,refname,read2qual,nvariables,skip_thresh,qual_thresh,modelfile,classifier,chunksize*i,chunksize*(i+1),train,training_pos_dict,None,None,None,base,motif,positions_list))
-            procs.append(p)
-            p.start()
-
-    if nprocs > 1:
-        if train:
-            # Collect all results into a signal matrix and an array of labels
-            signal_mat = []
-            label_array = []
-            context_array = []
-            for i,proc in enumerate(procs):
-                tmp_signal_mat,tmp_label_array,tmp_contexts = out_q.get()
-                print('updating with results from process',i)
-                signal_mat.extend(tmp_signal_mat)
-                label_array.extend(tmp_label_array)
-                context_array.extend(tmp_contexts)
-
-             # Wait for all worker processes to finish
-        for p in procs:
-            p.join ()
-       
     print('Finished extracting signals')
 
-    if train: 
+    if train and incremental:
+       #stream batches from the worker files instead of gathering them
+       assert sum(span[2] for span in train_spans) > 5, 'insufficient data aligned to labeled positions for training'
+       with timer.stage('training'):
+          train_incremental(lambda rng: iter_training_batches(train_spans,nvariables,TRAIN_BATCH_ROWS,rng),label_names(training_pos_dict),
+                            modelfile,classifier,epochs=epochs,holdout=holdout)
+       timer.count('training',observations=sum(span[2] for span in train_spans))
+       for trainname in set(span[0] for span in train_spans):
+           os.remove(trainname)
+       print('Finished training')
+    elif train: 
        assert len(label_array) > 5, 'insufficient data aligned to labeled positions for training'
-       train_classifier(signal_mat,label_array,context_array,modelfile,classifier) 
+       with timer.stage('training'):
+          train_classifier(signal_mat,label_array,context_array,modelfile,classifier,nprocs=nprocs,search=search) 
+       timer.count('training',observations=len(label_array))
        print('Finished training') 
 
+    if report:
+        #shards finished by an interrupted run are not in the report
+        write_report(report,timer.summary(),shard_summaries,tsv=tsvname,output=tsv_output,threads=nprocs,engine=engine,train=train,
+                     shards=len(shard_spans),resumed_shards=len(done))
+
 
 def main():
     #parse command line options
@@ -126,8 +290,9 @@ def main():
     all_or_some.add_argument('-p','--positions',type=str,required=False, help='file with a list of positions at which to classify bases (must be formatted as space- or tab-separated file with chromosome, position, strand, and label if training)')
     all_or_some.add_argument('-m','--motif',type=str,required=False, help='classify every base of type --base in the motif specified instead (can be single one-mer)')
     parser.add_argument('-r','--reference',type=str,required=True,help='fasta file with reference aligned to')
-    parser.add_argument('-e','--tsv',type=str,required=True,help='tsv file with nanopolish event alignment')
-    parser.add_argument('-f','--fastq',type=str,required=True,help='fastq file with nanopore reads')
+    parser.add_argument('-e','--tsv',type=str,required=True,help='tsv file with nanopolish event alignment, which can be gzip or bgzip compressed (- or a named pipe to stream from nanopolish eventalign)')
+    parser.add_argument('-o','--output',type=str,required=False,help='output file (default: tsv name with .diffs.<num_variables>, required when streaming)')
+    parser.add_argument('-f','--fastq',type=str,required=True,help='fastq file with nanopore reads (can be gzip or bgzip compressed)')
     parser.add_argument('-t','--threads',type=int,required=False,help='specify number of processes (default = 1)',default=1)
     parser.add_argument('-b','--base',type=str,required=False,help='bases to classify as methylated or unmethylated (A or C, default A)',default='A')
     parser.add_argument('-n','--num_variables',type=int,required=False,help='change the length of the context used to classify (default of 6 variables corresponds to 11-mer context (6*2-1))',default=6)
@@ -136,6 +301,17 @@ def main():
     parser.add_argument('-s','--skip_thresh',type=int,required=False,help='number of skips to allow within an observation (default 0)',default=0)
     parser.add_argument('-q','--qual_thresh',type=float,required=False,help='quality threshold for reads (under development, please sort your own reads for now)',default=0)
     parser.add_argument('-c','--classifier',type=str,required=False,help='use alternative classifier: options = NN (default) RF, LR, or NBC',default='NN')
+    parser.add_argument('--batch_size',type=int,required=False,help='number of observations to classify at once (default 4096)',default=4096)
+    parser.add_argument('--engine',type=str,required=False,choices=['loop','block'],help='feature extraction: loop over rows (default) or block, which handles whole reads with array operations and gives the same output',default='loop')
+    parser.add_argument('--incremental',action='store_true',required=False,help='train with partial_fit on batches read from disk, validating on held-out contexts, for training sets too large for memory (NN, NBC or LR)',default=False)
+    parser.add_argument('--epochs',type=int,required=False,help='passes over the training data with --incremental (default 5)',default=5)
+    parser.add_argument('--holdout',type=float,required=False,help='fraction of contexts held out for validation with --incremental (default 0.2)',default=0.2)
+    parser.add_argument('--search',type=int,nargs='?',const=20,required=False,help='when training, try up to this many parameter settings (default 20) with 5-fold cross-validation grouped by context, running the fits in --threads processes, and keep the best',default=0)
+    parser.add_argument('--resume',action='store_true',required=False,help='continue an interrupted run with the same tsv and output from its last checkpoints',default=False)
+    parser.add_argument('--bgzip',action='store_true',required=False,help='write the output compressed with bgzip (default name ending .gz) along with a tabix index (.tbi) for reading regions of it',default=False)
+    parser.add_argument('--report',type=str,required=False,help='JSON file for the time and row, observation and skip counts of each stage, per process and in total')
+    parser.add_argument('--profile',type=str,required=False,help='directory for cProfile stats of the main process and each worker process (and of the training and search processes), and a summary of the hotspots over all of them')
+    parser.add_argument('--profile_memory',action='store_true',required=False,help='with --profile, also trace memory allocations and save a tracemalloc snapshot of each process',default=False)
     parser.add_argument('-v','--version',action='store_true',required=False,help='print version')
     args = parser.parse_args()
 
@@ -164,22 +340,39 @@ def main():
     else:
         base = args.base
 
+    assert args.output or args.tsv != '-', 'output file (-o) required when streaming the tsv from stdin'
+    if args.resume and is_stream(args.tsv):
+        parser.error('--resume cannot be used when the tsv is streamed or gzip (rather than bgzip) compressed')
+
+    assert not args.incremental or args.classifier.split('_')[0] in ['NN','NBC','LR'], 'only NN, NBC or LR classifiers can be trained with --incremental'
+    assert not (args.search and args.incremental), '--search cannot be combined with --incremental'
+    assert args.epochs > 0 and 0 <= args.holdout < 1, '--epochs must be at least 1 and --holdout between 0 and 1'
+
     assert (args.skip_thresh < args.num_variables/2), 'too many skips with only '+str(args.num_variables)+' variables - try < half' 
 
     assert os.path.isfile(args.fastq), 'fastq file not found at '+args.fastq
-    read2qual = extract_read_quality(args.fastq)
+    assert args.profile or not args.profile_memory, '--profile_memory requires --profile'
+    if args.profile:
+        clear_profiles(args.profile)
+        start_profile(args.profile,'main',memory=args.profile_memory)
 
-    try:
-        num_refs = 0
-        for ref in SeqIO.parse(args.reference,"fasta"):
-            num_refs+=1
-    except IOError:
-        print('reference file missing')
-        sys.exit(0)
+    with profiled():
+        timer = StageTimer()
+        with timer.stage('quality_loading'):
+            read_table = extract_read_quality(args.fastq,nprocs=args.threads)
+        timer.count('quality_loading',reads=len(read_table[0]))
+
+        if not os.path.isfile(args.reference):
+            print('reference file missing')
+            sys.exit(0)
+
+        #distribute to multiple threads for main computations
+        distribute_threads(args.positions,args.motif,args.tsv,read_table,args.reference,base,mod,args.threads,args.num_variables,
+            args.train,modelfile,args.skip_thresh,args.qual_thresh,args.classifier,batch_size=args.batch_size,tsv_output=args.output,engine=args.engine,resume=args.resume,
+            incremental=args.incremental,epochs=args.epochs,holdout=args.holdout,search=args.search,timer=timer,report=args.report,compress=args.bgzip)
 
-    #distribute to multiple threads for main computations
-    distribute_threads(args.positions,args.motif,args.tsv,read2qual,args.reference,num_refs,base,mod,args.threads,args.num_variables,
-        args.train,modelfile,args.skip_thresh,args.qual_thresh,args.classifier)
+    if args.profile:
+        print('profile summary saved to',summarize_profiles(args.profile))
 
 if __name__ == "__main__":
     main()
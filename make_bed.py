@@ -3,6 +3,8 @@ import sys
 import numpy as np
 import os
 
+from diffs_index import read_diffs
+
 def make_pos_set(pos_list):
     pos_set = set()
     with open(pos_list,'r') as fi:
@@ -11,50 +13,128 @@ def make_pos_set(pos_list):
                 pos_set.add(tuple(line.split('\n')[0].split('\t')))
     return pos_set
 
-def check_thresh(locus_list,mod_thresh,depth_thresh,control):
-    if len(locus_list) >= depth_thresh:
-        if not control and np.mean(locus_list) >= mod_thresh:
+def check_thresh(nobs,frac,mod_thresh,depth_thresh,control):
+    if nobs >= depth_thresh:
+        if not control and frac >= mod_thresh:
             return True
-        elif control and np.mean(locus_list) < mod_thresh:
+        elif control and frac < mod_thresh:
             return True
         else:
             return False
 
-def aggregate_by_pos(meth_fi,aggfi,depth_thresh,mod_thresh,pos_list,control):
-    pos_dict = {}
+#per-site counters are kept instead of every call: observations and calls of the modification.
+#sites are keyed by chromosome, position, context and strand, and reported in the order they first appear in the input.
+#unsorted input is added to the site table this many calls at a time
+SITE_CHUNK = 1<<16
 
-    if pos_list:
-        pos_set = make_pos_set(pos_list)
-    #print(pos_set)
+#mCaller output sorted by chromosome, position and strand (as written by mCaller_nanopolish.py) is summarized one position
+#at a time in constant memory; any other order falls back to a table of all sites
+class UnsortedInput(ValueError):
+    pass
 
-    for line in open(meth_fi,'r'):
+#(sort order, site, whether called methylated) for each line of mCaller output, with or without the probability column.
+#lines that cannot be parsed are counted in skipped[0] and left out. the output can be compressed, and with regions (eg.
+#chr:start-end) only the calls in them are read, straight from the part of the file they are in if it has a tabix index
+def iter_calls(meth_fi,skipped,regions=None):
+    for line in read_diffs(meth_fi,regions):
+        fields = line.split('\t')
+        if len(fields) in (7,8):
+            csome,read,pos,context,values,strand,label = fields[:7]
+        else:
+            skipped[0] += 1
+            continue
         try:
-            try:
-                csome,read,pos,context,values,strand,label,prob = tuple(line.split('\t'))
-            except:
-                csome,read,pos,context,values,strand,label = tuple(line.split('\t'))
-            nextpos = str(int(pos)+1)
-            if (csome,pos,nextpos,context,strand) not in pos_dict:
-                pos_dict[(csome,pos,nextpos,context,strand)] = []
-            if label[0] == 'm':
-                pos_dict[(csome,pos,nextpos,context,strand)].append(1)
-            else:
-                pos_dict[(csome,pos,nextpos,context,strand)].append(0)
-        except:
-            pass
-
-        #print(pos_dict)
+            ipos = int(pos)
+        except ValueError:
+            skipped[0] += 1
+            continue
+        if not label:
+            skipped[0] += 1
+            continue
+        yield (csome,ipos,strand),'\t'.join((csome,pos,context,strand)),label[0] == 'm'
+
+#(site, observations, methylated calls) for input in mCaller's order, raising UnsortedInput otherwise.
+#the few sites at one position (eg. different contexts) are kept in order of appearance until the position is passed
+def sorted_sites(meth_fi,skipped,regions=None):
+    last_order = None
+    current = {}
+    for order,site,meth in iter_calls(meth_fi,skipped,regions):
+        if order != last_order:
+            if last_order is not None and order < last_order:
+                raise UnsortedInput(meth_fi+' is not sorted by chromosome, position and strand')
+            for site_counts in current.items():
+                yield (site_counts[0],)+tuple(site_counts[1])
+            current = {}
+            last_order = order
+        if site not in current:
+            current[site] = [0,0]
+        counts = current[site]
+        counts[0] += 1
+        counts[1] += meth
+    for site_counts in current.items():
+        yield (site_counts[0],)+tuple(site_counts[1])
+
+#(site, observations, methylated calls) for input in any order. each site gets a slot in order of first
+#appearance, and calls are added to arrays of per-slot counters a chunk at a time
+def table_sites(meth_fi,skipped,regions=None):
+    slots = {}
+    nobs = np.zeros(0,dtype=np.int64)
+    nmeth = np.zeros(0,dtype=np.int64)
+    chunk_slots,chunk_meth = [],[]
+    calls = iter_calls(meth_fi,skipped,regions)
+    while True:
+        for order,site,meth in calls:
+            if site not in slots:
+                slots[site] = len(slots)
+            chunk_slots.append(slots[site])
+            chunk_meth.append(meth)
+            if len(chunk_slots) == SITE_CHUNK:
+                break
+        if not chunk_slots:
+            break
+        if len(slots) > len(nobs):
+            size = max(len(slots),2*len(nobs))
+            nobs,nmeth = [np.append(counts,np.zeros(size-len(counts),dtype=counts.dtype)) for counts in (nobs,nmeth)]
+        nobs += np.bincount(chunk_slots,minlength=len(nobs))
+        nmeth += np.bincount(chunk_slots,weights=chunk_meth,minlength=len(nobs)).astype(np.int64)
+        chunk_slots,chunk_meth = [],[]
+    for site,slot in slots.items():
+        yield site,int(nobs[slot]),int(nmeth[slot])
+
+def write_sites(sites,outfi,depth_thresh,mod_thresh,pos_set,control):
     count = 0
-    outfi = open(aggfi,'w')
-    for locus in pos_dict:
-        if not pos_list:
-            if check_thresh(pos_dict[locus],mod_thresh,depth_thresh,control):# np.mean(pos_dict[locus]) > mod_thresh and len(pos_dict[locus]) >= depth_thresh:
+    for site,nobs,nmeth in sites:
+        csome,pos,context,strand = site.split('\t')
+        nextpos = str(int(pos)+1)
+        frac = nmeth/float(nobs)
+        if pos_set is None:
+            if check_thresh(nobs,frac,mod_thresh,depth_thresh,control):
                 count+=1
-                outfi.write('\t'.join(list(locus)[:-1]+[str(np.mean(pos_dict[locus]))]+[locus[-1]]+[str(len(pos_dict[locus]))])+'\n')
+                outfi.write('\t'.join([csome,pos,nextpos,context,str(frac),strand,str(nobs)])+'\n')
         else:
-            if (locus[0],locus[1],locus[2],locus[4]) in pos_set and 'A' not in set(locus[4]): #TODO: fix main script for As 
-                #print(locus[1],locus[4])
-                outfi.write('\t'.join(list(locus)[:-1]+[str(np.mean(pos_dict[locus]))]+[locus[-1]]+[str(len(pos_dict[locus]))])+'\n')#+[','.join([str(x) for x in pos_dict[locus]])]+'\n')
+            if (csome,pos,nextpos,strand) in pos_set and 'A' not in set(strand): #TODO: fix main script for As
+                outfi.write('\t'.join([csome,pos,nextpos,context,str(frac),strand,str(nobs)])+'\n')
+    return count
+
+def aggregate_by_pos(meth_fi,aggfi,depth_thresh,mod_thresh,pos_list,control,regions=None):
+    if pos_list:
+        pos_set = make_pos_set(pos_list)
+    else:
+        pos_set = None
+
+    skipped = [0]
+    outfi = open(aggfi,'w')
+    try:
+        count = write_sites(sorted_sites(meth_fi,skipped,regions),outfi,depth_thresh,mod_thresh,pos_set,control)
+    except UnsortedInput as err:
+        print(err,'- summarizing with a table of all sites')
+        outfi.seek(0)
+        outfi.truncate()
+        skipped = [0]
+        count = write_sites(table_sites(meth_fi,skipped,regions),outfi,depth_thresh,mod_thresh,pos_set,control)
+    outfi.close()
+    if skipped[0]:
+        print(skipped[0],'lines could not be read and were skipped')
     if not pos_list:
         print(count, 'methylated loci found with min depth', depth_thresh, 'reads')
 
@@ -64,7 +144,8 @@ def main():
     parser = ArgumentParser(description='Produce bed file of methylated positions based on mCaller output')
     parser.add_argument('-d','--min_read_depth',type=int,required=False,help='minimum coverage of position to determine methylation (default = 15)',default=15)
     parser.add_argument('-t','--mod_threshold',type=float,required=False,help='minimum %% of observations at a position to include in report (default = 0.5)',default=0.5)
-    parser.add_argument('-f','--mCaller_file',type=str,required=True,help='the output file from mCaller to summarize')
+    parser.add_argument('-f','--mCaller_file',type=str,required=True,help='the output file from mCaller to summarize (can be gzip or bgzip compressed)')
+    parser.add_argument('-r','--region',type=str,nargs='+',required=False,help='only summarize calls in these regions (contig, contig:start or contig:start-end, 1-based and inclusive), read directly from output compressed with bgzip')
     parser.add_argument('-p','--positions',type=str,required=False,help='~bed file of positions for which to calculate % methylated (chromosome,start,end,strand)')
     parser.add_argument('--control',type=str,required=False,help='take unmethylated positions as a control for motif detection',default=False)
     parser.add_argument('-v','--version',action='store_true',required=False,help='print version')
@@ -84,7 +165,7 @@ def main():
 
     print(args.mCaller_file)
 
-    aggregate_by_pos(args.mCaller_file,output_file,args.min_read_depth,args.mod_threshold,args.positions,args.control)
+    aggregate_by_pos(args.mCaller_file,output_file,args.min_read_depth,args.mod_threshold,args.positions,args.control,regions=args.region)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,67 @@
+#Sorting and streaming k-way merge of diffs files so that output is the same whatever the number of processes
+
+import heapq
+import os
+
+from bgzf import BgzfWriter
+from diffs_index import DiffsIndex,tbi_name
+
+#merge at most this many sorted runs at once to stay within open file limits
+MERGE_FANIN = 256
+
+#diffs lines are ordered by contig, position, strand and read (the whole line breaks any remaining ties)
+def diffs_key(line):
+    fields = line.split(b'\t',6)
+    return (fields[0],int(fields[2]),fields[5],fields[1],line)
+
+def sort_lines(lines):
+    return sorted(lines,key=diffs_key)
+
+#lines in the byte range [start,end) of a file
+def read_span(filename,start,end):
+    with open(filename,'rb') as fi:
+        fi.seek(start)
+        offset = start
+        while offset < end:
+            line = fi.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield line
+
+#with an index, each line is added to it at the (virtual) offset it is written to
+def merge_runs(spans,outfi,index=None):
+    for line in heapq.merge(*[read_span(*span) for span in spans],key=diffs_key):
+        if index is not None:
+            index.add(line,outfi.tell())
+        outfi.write(line)
+
+#merge sorted runs, given as (file, start, end) spans, into one sorted file using memory proportional to the fan-in. with
+#compress, the file is written BGZF compressed along with a tabix index (output.tbi) for reading regions of it
+def merge_spans(spans,output,fanin=MERGE_FANIN,compress=False):
+    temp_files = []
+    level = 0
+    while len(spans) > fanin:
+        merged = []
+        for i in range(0,len(spans),fanin):
+            tempname = output+'.merge'+str(level)+'_'+str(i//fanin)
+            with open(tempname,'wb') as tempfi:
+                merge_runs(spans[i:i+fanin],tempfi)
+            merged.append((tempname,0,os.path.getsize(tempname)))
+        #runs from the previous level are no longer needed
+        for tempname in temp_files:
+            os.remove(tempname)
+        temp_files = [span[0] for span in merged]
+        spans = merged
+        level += 1
+    if compress:
+        outfi,index = BgzfWriter(output),DiffsIndex()
+        merge_runs(spans,outfi,index)
+        end = outfi.tell()
+        outfi.close()
+        index.save(tbi_name(output),end)
+    else:
+        with open(output,'wb') as outfi:
+            merge_runs(spans,outfi)
+    for tempname in temp_files:
+        os.remove(tempname)
@@ -0,0 +1,83 @@
+#Classifiers exported from scikit-learn (see export_model in train_model.py) run with numpy alone, so that workers
+#neither import scikit-learn nor depend on the version that trained the model
+
+import numpy as np
+import os
+
+WEIGHTS_VERSION = 1
+
+#weights are saved next to the pickled model, eg. model_NN_6_m6A.pkl -> model_NN_6_m6A.npz
+def weights_name(modelfile):
+    return os.path.splitext(modelfile)[0]+'.npz'
+
+def is_weights_file(modelfile):
+    with open(modelfile,'rb') as modfi:
+        return modfi.read(2) == b'PK'
+
+ACTIVATIONS = {'identity':lambda x: x,
+               'tanh':np.tanh,
+               'relu':lambda x: np.maximum(x,0),
+               'logistic':lambda x: 1/(1+np.exp(-x))}
+
+#predict_proba for an exported model, returning probabilities for classes in the order of classes_
+class NumpyModel(object):
+    def __init__(self,weights):
+        self.kind = str(weights['kind'])
+        self.classes_ = weights['classes']
+        self.weights = weights
+
+    def predict_proba(self,X):
+        X = np.asarray(X,dtype=np.float64)
+        w = self.weights
+        if self.kind == 'MLP':
+            activation = ACTIVATIONS[str(w['activation'])]
+            nlayers = int(w['nlayers'])
+            for i in range(nlayers):
+                X = X.dot(w['coef_%d' % i])+w['intercept_%d' % i]
+                if i < nlayers-1:
+                    X = activation(X)
+            if str(w['out_activation']) == 'softmax':
+                return softmax(X)
+            prob = ACTIVATIONS[str(w['out_activation'])](X).ravel()
+            return np.column_stack([1-prob,prob])
+        elif self.kind == 'LR':
+            scores = X.dot(w['coef'].T)+w['intercept']
+            if scores.shape[1] == 1:
+                prob = ACTIVATIONS['logistic'](scores).ravel()
+                return np.column_stack([1-prob,prob])
+            #weights files from before the multi-class mode was recorded only held one-vs-rest models
+            if str(w.get('multi_class','ovr')) == 'multinomial':
+                return softmax(scores)
+            prob = ACTIVATIONS['logistic'](scores)
+            return prob/prob.sum(axis=1)[:,None]
+        elif self.kind == 'NBC':
+            jll = np.log(w['class_prior'])-0.5*np.log(2*np.pi*w['var']).sum(axis=1)
+            jll = jll-0.5*(((X[:,None,:]-w['theta'])**2)/w['var']).sum(axis=2)
+            top = jll.max(axis=1)[:,None]
+            return np.exp(jll-(top+np.log(np.exp(jll-top).sum(axis=1))[:,None]))
+        elif self.kind == 'RF':
+            #every tree is walked for every row at once, one level per step; trees compare float32 features as in scikit-learn
+            X = X.astype(np.float32)
+            left,right,feature,threshold = w['left'],w['right'],w['feature'],w['threshold']
+            nodes = np.repeat(w['roots'][None,:],len(X),axis=0)
+            rows = np.arange(len(X))[:,None]
+            active = left[nodes] >= 0
+            while active.any():
+                current = nodes[active]
+                go_left = X[np.broadcast_to(rows,nodes.shape)[active],feature[current]] <= threshold[current]
+                nodes[active] = np.where(go_left,left[current],right[current])
+                active = left[nodes] >= 0
+            return w['value'][nodes].mean(axis=1)
+        raise ValueError('unknown model type in weights file: '+self.kind)
+
+def softmax(scores):
+    scores = scores-scores.max(axis=1)[:,None]
+    prob = np.exp(scores)
+    return prob/prob.sum(axis=1)[:,None]
+
+def load_weights(filename):
+    with np.load(filename,allow_pickle=False) as npz:
+        weights = {key:npz[key] for key in npz.files}
+    if int(weights['version']) != WEIGHTS_VERSION:
+        raise ValueError('weights file '+filename+' has version '+str(int(weights['version']))+', expected '+str(WEIGHTS_VERSION))
+    return NumpyModel(weights)
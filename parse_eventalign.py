@@ -0,0 +1,135 @@
+#Chunked columnar parsing of nanopolish eventalign tsv files
+
+import numpy as np
+
+from bgzf import open_input
+
+#bytes read from the tsv at a time
+CHUNK_SIZE = 1<<24
+
+#tsv format: contig position reference_kmer read_name strand event_index event_level_mean event_stdv event_length model_kmer model_mean model_stdv standardized_level [samples]
+#only these columns are converted, the rest (including the samples, which are never used) are skipped over
+STR_COLUMNS = {'reference_kmer':2,'model_kmer':9}
+#contig and read name repeat for whole read blocks, so they are kept as bytes and decoded once per block
+BYTES_COLUMNS = {'contig':0,'read_name':3}
+INT_COLUMNS = {'position':1,'event_index':5}
+FLOAT_COLUMNS = {'event_level_mean':6,'model_mean':10}
+COLUMNS = {**BYTES_COLUMNS,**STR_COLUMNS,**INT_COLUMNS,**FLOAT_COLUMNS}
+
+#read the byte range [start,end) of a tsv in large chunks that end on line boundaries. offsets in a compressed tsv are
+#in its decompressed data, and a process reading part of a BGZF file only decompresses the blocks that part is in
+def read_chunks(tsv_input,start,end=None,chunk_size=CHUNK_SIZE):
+    with open_input(tsv_input) as tsv:
+        tsv.seek(start)
+        remaining = None if end is None else end-start
+        leftover = b''
+        while remaining is None or remaining > 0:
+            data = tsv.read(chunk_size if remaining is None else min(chunk_size,remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            data = leftover+data
+            cut = data.rfind(b'\n')+1
+            leftover = data[cut:]
+            if cut:
+                yield data[:cut]
+        if leftover:
+            yield leftover+b'\n'
+
+#the 8 bytes starting at each offset of a chunk as a little-endian integer, so that a field of up to 8 bytes is read
+#with one lookup
+def chunk_words(buf):
+    return np.ndarray((max(len(buf)-7,0),),dtype='<u8',buffer=buf,strides=(1,))
+
+#masks of the lowest 0 to 8 bytes of a word (the first bytes in the chunk)
+LOW_BYTES = np.array([(1<<(8*n))-1 for n in range(9)],dtype=np.uint64)
+
+#each field of a column as a row of bytes, left aligned and zero padded to the longest field
+def field_windows(buf,words,starts,ends):
+    if len(starts) == 0:
+        return np.zeros((0,1),dtype=np.uint8)
+    widths = ends-starts
+    width = max(int(widths.max()),1)
+    if width <= 8 and int(starts.max()) < len(words):
+        return (words[starts] & LOW_BYTES[widths]).view(np.uint8).reshape(-1,8)[:,:width]
+    if int(starts.max())+width > len(buf):
+        buf = np.append(buf,np.zeros(width,dtype=np.uint8))
+    chars = np.lib.stride_tricks.sliding_window_view(buf,width)[starts]
+    short = np.flatnonzero(widths < width)
+    chars[short] = np.where(np.arange(width) < widths[short,None],chars[short],0)
+    return chars
+
+#fixed-width bytes values of a column, sized to its longest value in the chunk so nothing is truncated
+def bytes_column(buf,words,starts,ends):
+    chars = np.ascontiguousarray(field_windows(buf,words,starts,ends))
+    return chars.view('S%d' % chars.shape[1]).ravel()
+
+#the same as strings, for ascii values: each byte is widened to a unicode code point rather than decoding value by value
+def str_column(buf,words,starts,ends):
+    chars = field_windows(buf,words,starts,ends)
+    return np.ascontiguousarray(chars,dtype=np.uint32).view('U%d' % chars.shape[1]).ravel()
+
+#numbers of a column, converted from its fixed-width bytes by numpy's C conversion
+def number_column(buf,words,starts,ends,integer=False):
+    return bytes_column(buf,words,starts,ends).astype(np.int64 if integer else np.float64)
+
+#the tab and newline offsets of a chunk of whole rows, found in one pass, from which the columns extract_features uses
+#are converted on demand, for all rows or only some of them
+class ChunkFields:
+    def __init__(self,chunk):
+        self.buf = np.frombuffer(chunk,dtype=np.uint8)
+        separators = np.flatnonzero(self.buf <= 10)
+        separators = separators[self.buf[separators] >= 9]
+        is_end = self.buf[separators] == 10
+        self.line_ends = separators[is_end]
+        self.nrows = len(self.line_ends)
+        if self.nrows == 0:
+            return
+        tabs = separators[~is_end]
+        if len(tabs)%self.nrows != 0:
+            raise ValueError('rows with different numbers of columns in eventalign tsv')
+        self.tabs = tabs.reshape(self.nrows,-1)
+        self.row_starts = np.append(0,self.line_ends[:-1]+1)
+        if (self.tabs[:,0] < self.row_starts).any() or (self.tabs[:,-1] > self.line_ends).any():
+            raise ValueError('rows with different numbers of columns in eventalign tsv')
+        if self.tabs.shape[1] < max(FLOAT_COLUMNS['model_mean'],STR_COLUMNS['model_kmer']):
+            raise ValueError('too few columns in eventalign tsv')
+        self.words = chunk_words(self.buf)
+
+    def column(self,name,rows=None):
+        col = COLUMNS[name]
+        starts = self.row_starts if col == 0 else self.tabs[:,col-1]+1
+        ends = self.tabs[:,col] if col < self.tabs.shape[1] else self.line_ends
+        if rows is not None:
+            starts,ends = starts[rows],ends[rows]
+        if name in BYTES_COLUMNS:
+            return bytes_column(self.buf,self.words,starts,ends)
+        if name in STR_COLUMNS:
+            return str_column(self.buf,self.words,starts,ends)
+        return number_column(self.buf,self.words,starts,ends,integer=name in INT_COLUMNS)
+
+#split a chunk of whole rows into numpy arrays, one per column that extract_features uses
+def parse_chunk(chunk):
+    fields = ChunkFields(chunk)
+    if fields.nrows == 0:
+        return None
+    return {name:fields.column(name) for name in COLUMNS}
+
+#decode a bytes array to a list of strings, decoding each run of repeated values once
+def decode_runs(values):
+    if len(values) == 0:
+        return []
+    change = np.flatnonzero(np.append(True,values[1:] != values[:-1]))
+    runs = np.diff(np.append(change,len(values)))
+    return np.repeat(np.array([value.decode() for value in values[change].tolist()],dtype=object),runs).tolist()
+
+#rows of the parsed chunks as (contig, position, reference kmer, read name, event index, model kmer, event - model current)
+def iter_rows(chunks):
+    for chunk in chunks:
+        columns = parse_chunk(chunk)
+        if columns is None:
+            continue
+        event_diffs = columns['event_level_mean']-columns['model_mean']
+        yield from zip(decode_runs(columns['contig']),columns['position'].tolist(),columns['reference_kmer'].tolist(),decode_runs(columns['read_name']),
+                       columns['event_index'].tolist(),columns['model_kmer'].tolist(),event_diffs.tolist())
@@ -0,0 +1,131 @@
+#Opt-in profiling of mCaller's processes for --profile: cProfile stats and, with --profile_memory, tracemalloc snapshots for
+#the main process and each worker, written to one directory along with a summary of the hotspots over all of them
+
+import cProfile
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+#frames kept for each traced allocation
+MEMORY_FRAMES = 8
+#a new snapshot replaces the last one only if this much more memory is traced
+SNAPSHOT_GROWTH = 1.1
+#allocations by the profilers themselves are left out of snapshots
+PROFILER_FILES = [cProfile.__file__,pstats.__file__,tracemalloc.__file__,__file__]
+SUMMARY_NAME = 'summary.txt'
+
+#the profiler of this process. a forked worker starts with a copy of its parent's, which is replaced by its own
+profile_state = {}
+
+def profile_base(profile_dir,role,pid):
+    return os.path.join(profile_dir,'%s_%d' % (role,pid))
+
+#remove the files of an earlier run from profile_dir, creating it if needed
+def clear_profiles(profile_dir):
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    for fi in os.listdir(profile_dir):
+        if fi == SUMMARY_NAME or fi.split('.')[-1] in ['prof','json','snapshot'] and fi.split('_')[0] in ['main','worker','search']:
+            os.remove(os.path.join(profile_dir,fi))
+
+#profile this process as role (main, worker or search), once per process
+def start_profile(profile_dir,role,memory=False):
+    if profile_state.get('pid') == os.getpid():
+        return
+    if profile_state:
+        profile_state['profiler'].disable()
+    profile_state.clear()
+    if memory:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(MEMORY_FRAMES)
+    profile_state.update({'pid':os.getpid(),'dir':profile_dir,'role':role,'memory':memory,'profiler':cProfile.Profile(),
+                          'depth':0,'units':0,'seconds':0.,'snapshot_bytes':-1})
+
+#what a worker process needs to profile itself, or None if this process is not being profiled
+def profile_settings():
+    if profile_state.get('pid') != os.getpid():
+        return None
+    return {'profile_dir':profile_state['dir'],'memory':profile_state['memory']}
+
+#profile one unit of work (a shard, a search fit, or the main process's run) and save the stats after it, so a worker's
+#files are complete whenever it is stopped. nested units are part of the outermost one
+@contextmanager
+def profiled():
+    if profile_state.get('pid') != os.getpid():
+        yield
+        return
+    profile_state['depth'] += 1
+    if profile_state['depth'] == 1:
+        tstart = time.time()
+        profile_state['profiler'].enable()
+    try:
+        yield
+    finally:
+        profile_state['depth'] -= 1
+        if profile_state['depth'] == 0:
+            profile_state['profiler'].disable()
+            profile_state['units'] += 1
+            profile_state['seconds'] += time.time()-tstart
+            save_profile()
+
+#keep a tracemalloc snapshot of this process if more memory is traced now than at its last snapshot. called where a unit of
+#work holds the most memory, eg. once a shard's output has been sorted. the time taken is left out of the profile
+def memory_snapshot():
+    if profile_state.get('pid') != os.getpid() or not profile_state['memory']:
+        return
+    traced = tracemalloc.get_traced_memory()[0]
+    if traced > profile_state['snapshot_bytes']*SNAPSHOT_GROWTH:
+        if profile_state['depth']:
+            profile_state['profiler'].disable()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,filename) for filename in PROFILER_FILES])
+        snapshot.dump(profile_base(profile_state['dir'],profile_state['role'],profile_state['pid'])+'.snapshot')
+        profile_state['snapshot_bytes'] = traced
+        if profile_state['depth']:
+            profile_state['profiler'].enable()
+
+def save_profile():
+    base = profile_base(profile_state['dir'],profile_state['role'],profile_state['pid'])
+    profile_state['profiler'].dump_stats(base+'.prof')
+    info = {key:profile_state[key] for key in ['role','pid','units','seconds']}
+    if profile_state['memory']:
+        info['traced_bytes'],info['peak_traced_bytes'] = tracemalloc.get_traced_memory()
+        info['snapshot_bytes'] = max(profile_state['snapshot_bytes'],0)
+    with open(base+'.json','w') as infofi:
+        json.dump(info,infofi)
+
+#merge the stats of every process profiled in profile_dir into a summary of the functions with the most time spent in
+#them (and under them), and the lines that allocated the most memory in the snapshots
+def summarize_profiles(profile_dir,ntop=30):
+    names = sorted(fi[:-len('.json')] for fi in os.listdir(profile_dir) if fi.endswith('.json'))
+    infos = [json.load(open(os.path.join(profile_dir,name+'.json'))) for name in names]
+    profiles = [os.path.join(profile_dir,name+'.prof') for name in names if os.path.exists(os.path.join(profile_dir,name+'.prof'))]
+    if not profiles:
+        return None
+    summaryname = os.path.join(profile_dir,SUMMARY_NAME)
+    with open(summaryname,'w') as summaryfi:
+        summaryfi.write('processes profiled:\n')
+        for info in infos:
+            memory = '' if 'peak_traced_bytes' not in info else ', %.1f MB peak traced memory' % (info['peak_traced_bytes']/1e6)
+            summaryfi.write('  %-7s %8d: %5d units of work, %9.2f s%s\n' % (info['role'],info['pid'],info['units'],info['seconds'],memory))
+        stats = pstats.Stats(*profiles,stream=summaryfi)
+        stats.strip_dirs()
+        for order in ['tottime','cumulative']:
+            summaryfi.write('\nfunctions by %s, over all processes:\n' % order)
+            stats.sort_stats(order).print_stats(ntop)
+        snapshots = [os.path.join(profile_dir,name+'.snapshot') for name in names if os.path.exists(os.path.join(profile_dir,name+'.snapshot'))]
+        if snapshots:
+            sizes,counts = defaultdict(int),defaultdict(int)
+            for snapshotname in snapshots:
+                for stat in tracemalloc.Snapshot.load(snapshotname).statistics('lineno'):
+                    frame = stat.traceback[0]
+                    sizes[(frame.filename,frame.lineno)] += stat.size
+                    counts[(frame.filename,frame.lineno)] += stat.count
+            summaryfi.write('\nlines holding the most memory at the largest snapshot of each process, summed over %d processes:\n' % len(snapshots))
+            for filename,lineno in sorted(sizes,key=sizes.get,reverse=True)[:ntop]:
+                summaryfi.write('  %10.1f KB %9d blocks  %s:%d\n' % (sizes[(filename,lineno)]/1024.,counts[(filename,lineno)],filename,lineno))
+    return summaryname
@@ -1,9 +1,189 @@
-from Bio import SeqIO
+#Mean phred quality of every read in a fastq, computed in parallel and saved to a sidecar table reused between runs
+
 import numpy as np
-import sys
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+
+from bgzf import open_input,input_size
+
+QUAL_VERSION = 2
+#bytes of fastq read at a time by each process
+CHUNK_SIZE = 1<<24
+#at most this many bytes of fastq per task, so processes stay busy until the end
+MAX_RANGE_BYTES = 1<<28
+
+def qual_name(fastqfi):
+   return fastqfi+'.qual'
+
+#offset of the first record that starts at or after offset: a line starting with @ two lines before a line starting with +
+#(quality lines can start with @, but the line two after them is a sequence)
+def record_start(fastq,offset):
+   fastq.seek(offset)
+   if offset > 0:
+      offset += len(fastq.readline())
+   lines = [fastq.readline() for i in range(3)]
+   while lines[0]:
+      if lines[0].startswith(b'@') and lines[2].startswith(b'+'):
+         return offset
+      offset += len(lines.pop(0))
+      lines.append(fastq.readline())
+   return offset
+
+#split a chunk of whole 4-line records into read names and mean qualities, summing quality bytes with numpy
+def chunk_qualities(chunk):
+   buf = np.frombuffer(chunk,dtype=np.uint8)
+   line_ends = np.flatnonzero(buf == 10)
+   line_starts = np.append(0,line_ends[:-1]+1)
+   headers,pluses,qual_starts,qual_ends = line_starts[0::4],line_starts[2::4],line_starts[3::4],line_ends[3::4]
+   seq_lengths = line_ends[1::4]-line_starts[1::4]
+   if len(line_ends)%4 or (buf[headers] != ord('@')).any() or (buf[pluses] != ord('+')).any():
+      raise ValueError('fastq is not in 4-line records')
+   #windows line endings
+   qual_ends = qual_ends-(buf[np.maximum(qual_ends-1,0)] == 13)
+   seq_lengths = seq_lengths-(buf[np.maximum(line_ends[1::4]-1,0)] == 13)
+   qual_lengths = qual_ends-qual_starts
+   if (qual_lengths != seq_lengths).any():
+      raise ValueError('fastq is not in 4-line records')
+   totals = np.append(0,np.cumsum(buf,dtype=np.int64))
+   #integer sums are exact, so this matches the mean of each read's phred scores
+   quals = (totals[qual_ends]-totals[qual_starts]-33*qual_lengths)/np.maximum(qual_lengths,1)
+   quals[qual_lengths == 0] = np.nan
+   names = [chunk[start+1:end].split(None,1)[0] if end > start+1 else b'' for start,end in zip(headers.tolist(),line_ends[0::4].tolist())]
+   return names,quals
+
+#names and mean qualities of the records starting in the byte range [start,end) of the (decompressed) fastq, or from start
+#to the end of the file if end is None
+def range_qualities(task):
+   fastqfi,start,end = task
+   names,quals = [],[]
+   with open_input(fastqfi) as fastq:
+      offset = record_start(fastq,start)
+      if start == 0 and offset != 0:
+         raise ValueError('fastq is not in 4-line records')
+      if end is not None and offset >= end:
+         return names,np.zeros(0)
+      remaining = record_start(fastq,end)-offset if end is not None else float('inf')
+      fastq.seek(offset)
+      leftover = b''
+      while remaining > 0 or leftover:
+         data = fastq.read(min(CHUNK_SIZE,remaining))
+         remaining = remaining-len(data) if data else 0
+         data = leftover+data
+         if not data:
+            break
+         if remaining <= 0 and not data.endswith(b'\n'):
+            data += b'\n'
+         #cut after the last complete 4-line record
+         cut,nlines = data.rfind(b'\n')+1,data.count(b'\n')
+         for i in range(nlines%4):
+            cut = data.rfind(b'\n',0,cut-1)+1
+         if remaining <= 0 and cut < len(data):
+            raise ValueError('fastq is not in 4-line records')
+         data,leftover = data[:cut],data[cut:]
+         chunk_names,chunk_quals = chunk_qualities(data)
+         names.extend(chunk_names)
+         quals.append(chunk_quals)
+   return names,np.concatenate(quals) if quals else np.zeros(0)
+
+#scan the fastq bytes directly, in ranges spread over nprocs processes. a BGZF compressed fastq is split the same way, with
+#each process decompressing its own range, but a gzip compressed one can only be read by one process from start to end
+def scan_qualities(fastqfi,nprocs=1):
+   size = input_size(fastqfi)
+   if size is None:
+      nprocs = 1
+      tasks = [(fastqfi,0,None)]
+   else:
+      nranges = max(nprocs,-(-size//MAX_RANGE_BYTES)) if nprocs > 1 else 1
+      bounds = [size*i//nranges for i in range(nranges+1)]
+      tasks = [(fastqfi,start,end) for start,end in zip(bounds[:-1],bounds[1:])]
+   if nprocs > 1:
+      pool = multiprocessing.Pool(nprocs)
+      results = pool.map(range_qualities,tasks)
+      pool.close()
+      pool.join()
+   else:
+      results = map(range_qualities,tasks)
+   names,quals = [],[]
+   for range_names,range_quals in results:
+      names.extend(range_names)
+      quals.append(range_quals)
+   return names,np.concatenate(quals)
+
+#biopython parser for fastq files that are not in 4-line records (eg. wrapped sequences)
+def parse_qualities(fastqfi):
+   from Bio import SeqIO
+   import io
+   names,quals = [],[]
+   with io.TextIOWrapper(open_input(fastqfi)) as fastq:
+      for read in SeqIO.parse(fastq,"fastq"):
+         names.append(read.id.encode())
+         quals.append(np.mean(read.letter_annotations["phred_quality"]))
+   return names,np.array(quals,dtype=np.float64)
+
+#names sorted for lookup with searchsorted, keeping the last quality seen for any repeated name
+def sort_qualities(names,quals):
+   names = np.array(names,dtype=bytes)
+   order = np.argsort(names,kind='stable')
+   names,quals = names[order],quals[order]
+   last = np.append(names[1:] != names[:-1],True)
+   return names[last],quals[last]
+
+def save_qualities(fastqfi,names,quals):
+   stat = os.stat(fastqfi)
+   with open(qual_name(fastqfi),'wb') as qualfi:
+      np.savez(qualfi,version=QUAL_VERSION,size=stat.st_size,mtime=stat.st_mtime,names=np.array(names,dtype=bytes),quals=quals)
+
+#returns None if there is no table or the fastq has changed since it was saved
+def load_qualities(fastqfi):
+   try:
+      with np.load(qual_name(fastqfi),allow_pickle=False) as npz:
+         table = {key:npz[key] for key in npz.files}
+   except (IOError,OSError,ValueError):
+      return None
+   stat = os.stat(fastqfi)
+   if table['version'].item() != QUAL_VERSION or table['size'].item() != stat.st_size or table['mtime'].item() != stat.st_mtime:
+      return None
+   return table['names'],table['quals']
+
+def extract_read_quality(fastqfi,nprocs=1):
+   table = load_qualities(fastqfi)
+   if table is None:
+      print('computing read qualities for',fastqfi)
+      try:
+         names,quals = scan_qualities(fastqfi,nprocs)
+      except ValueError:
+         names,quals = parse_qualities(fastqfi)
+      names,quals = sort_qualities(names,quals)
+      try:
+         save_qualities(fastqfi,names,quals)
+      except (IOError,OSError):
+         print('could not save read qualities to',qual_name(fastqfi))
+   else:
+      names,quals = table
+   return names,quals.astype(np.float32)
+
+#integer ids (positions in the sorted name table) for an array of read names
+def read_ids(names,read_names):
+   ids = np.minimum(np.searchsorted(read_names,names),max(len(read_names)-1,0))
+   missing = read_names[ids] != names if len(read_names) else np.ones(len(names),dtype=bool)
+   if missing.any():
+      raise KeyError('read '+names[missing][0].decode()+' not found in fastq')
+   return ids
+
+#copy the name and quality tables into shared memory once so that every worker maps the same pages;
+#returns what a worker needs to attach to them and the blocks, which the caller should close and unlink when done
+def share_read_table(read_names,read_quals):
+   blocks,table = [],[]
+   for array in [read_names,read_quals]:
+      block = shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+      np.ndarray(array.shape,dtype=array.dtype,buffer=block.buf)[:] = array
+      blocks.append(block)
+      table.append((block.name,array.dtype.str,array.shape))
+   return table,blocks
 
-def extract_read_quality(fastqfi):
-   read2qual = {}
-   for read in SeqIO.parse(fastqfi,"fastq"):
-      read2qual[read.id] = np.mean(read.letter_annotations["phred_quality"])
-   return read2qual
+#the shared name and quality arrays, plus the blocks they live in, which must stay open while the arrays are used
+def attach_read_table(table):
+   blocks = [shared_memory.SharedMemory(name=name) for name,dtype,shape in table]
+   arrays = [np.ndarray(shape,dtype=dtype,buffer=block.buf) for block,(name,dtype,shape) in zip(blocks,table)]
+   return arrays,blocks
@@ -0,0 +1,114 @@
+#Random access to contigs in a fasta reference through a samtools-style .fai index, with a size-bounded cache of prepared contigs
+
+from collections import OrderedDict
+import os
+
+#total bytes of sequence and site arrays kept in each process's cache of prepared contigs
+CONTIG_CACHE_BYTES = 1<<30
+
+def fai_name(refname):
+    return refname+'.fai'
+
+#one line per contig: name, length, offset of the first base, bases per line, bytes per line (as written by samtools faidx)
+def build_fai(refname):
+    fai = OrderedDict()
+    name = None
+    with open(refname,'rb') as ref:
+        offset = 0
+        for line in ref:
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode()
+                if name in fai:
+                    raise ValueError('duplicate contig name in reference: '+name)
+                fai[name] = [0,offset+len(line),0,0]
+                last_width = None
+            elif name is not None:
+                entry = fai[name]
+                bases = len(line.rstrip(b'\r\n'))
+                if last_width is not None and (last_width != entry[3] or bases > entry[2]):
+                    raise ValueError('lines of different lengths in reference contig '+name+' (reformat with samtools faidx or seqtk)')
+                if entry[3] == 0:
+                    entry[2],entry[3] = bases,len(line)
+                entry[0] += bases
+                last_width = len(line)
+            offset += len(line)
+    return OrderedDict((name,tuple(entry)) for name,entry in fai.items())
+
+def save_fai(fai,refname):
+    with open(fai_name(refname),'w') as faifi:
+        for name,(length,offset,linebases,linewidth) in fai.items():
+            faifi.write('%s\t%d\t%d\t%d\t%d\n' % (name,length,offset,linebases,linewidth))
+
+#returns None if there is no index or it is older than the reference
+def load_fai(refname):
+    try:
+        if os.path.getmtime(fai_name(refname)) < os.path.getmtime(refname):
+            return None
+        fai = OrderedDict()
+        with open(fai_name(refname),'r') as faifi:
+            for line in faifi:
+                fields = line.split('\t')
+                fai[fields[0]] = tuple(int(x) for x in fields[1:5])
+    except (IOError,OSError,ValueError,IndexError):
+        return None
+    return fai
+
+#indexes are kept for the life of the process, keyed by reference file
+loaded_fais = {}
+
+def get_fai(refname):
+    if refname not in loaded_fais:
+        fai = load_fai(refname)
+        if fai is None:
+            print('indexing',refname)
+            fai = build_fai(refname)
+            try:
+                save_fai(fai,refname)
+            except (IOError,OSError):
+                print('could not save index to',fai_name(refname))
+        loaded_fais[refname] = fai
+    return loaded_fais[refname]
+
+def contig_names(refname):
+    return list(get_fai(refname))
+
+#upper case sequence of one contig, or None if it is not in the reference
+def fetch_contig(refname,contigname):
+    fai = get_fai(refname)
+    if contigname not in fai:
+        return None
+    length,offset,linebases,linewidth = fai[contigname]
+    if length == 0:
+        return ''
+    nlines = (length-1)//linebases
+    with open(refname,'rb') as ref:
+        ref.seek(offset)
+        data = ref.read(nlines*linewidth+length-nlines*linebases)
+    if linewidth > linebases:
+        data = b''.join(data[i:i+linebases] for i in range(0,len(data),linewidth))
+    return data.decode().upper()
+
+#least recently used contigs are dropped once the cache holds more than max_bytes, always keeping the newest
+class ContigCache(object):
+    def __init__(self,max_bytes=CONTIG_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.contigs = OrderedDict()
+        self.sizes = {}
+        self.total = 0
+
+    def get(self,key):
+        if key not in self.contigs:
+            return None
+        self.contigs.move_to_end(key)
+        return self.contigs[key]
+
+    def put(self,key,value,size):
+        if key in self.contigs:
+            self.total -= self.sizes.pop(key)
+            del self.contigs[key]
+        self.contigs[key] = value
+        self.sizes[key] = size
+        self.total += size
+        while self.total > self.max_bytes and len(self.contigs) > 1:
+            old,_ = self.contigs.popitem(last=False)
+            self.total -= self.sizes.pop(old)
@@ -0,0 +1,102 @@
+#Wall time and counters for each stage of a run, kept by every worker for each shard it processes and combined by the parent
+#into the JSON report written with --report
+
+import json
+import os
+import platform
+import sys
+import time
+
+#profiling is the time taken by --profile_memory snapshots, kept out of the stages they are taken in
+STAGES = ['quality_loading','reference_marking','parsing','feature_assembly','classification','output','training','profiling']
+
+#stages can be nested (the contig loading that parsing sets off, or the batch a new observation sends to the classifier),
+#in which case time is only counted in the innermost stage so that the stages add up to the time spent in them
+class StageTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {stage:{'seconds':0.} for stage in STAGES}
+        self.active = []
+        self.last = None
+
+    def enter(self,stage):
+        now = time.perf_counter()
+        if self.active:
+            self.stages[self.active[-1]]['seconds'] += now-self.last
+        self.active.append(stage)
+        self.last = now
+
+    def leave(self):
+        now = time.perf_counter()
+        self.stages[self.active.pop()]['seconds'] += now-self.last
+        self.last = now
+
+    def stage(self,stage):
+        return TimedStage(self,stage)
+
+    #items of an iterable, with the time taken to produce each counted in the stage
+    def iterate(self,stage,iterable):
+        items = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            yield item
+
+    def count(self,stage,**counts):
+        counters = self.stages[stage]
+        for name,n in counts.items():
+            counters[name] = counters.get(name,0)+n
+
+    def summary(self):
+        return {'pid':os.getpid(),'seconds':time.perf_counter()-self.started,'stages':self.stages}
+
+class TimedStage:
+    def __init__(self,timer,stage):
+        self.timer,self.name = timer,stage
+
+    def __enter__(self):
+        self.timer.enter(self.name)
+
+    def __exit__(self,*exc):
+        self.timer.leave()
+
+#add the seconds and counters of each stage in stages to those in total
+def add_stages(total,stages):
+    for stage,counters in stages.items():
+        total_counters = total.setdefault(stage,{})
+        for name,n in counters.items():
+            total_counters[name] = total_counters.get(name,0)+n
+    return total
+
+#per-worker figures summed over the shards each worker processed (each shard summary as returned by StageTimer.summary),
+#and totals over the workers and the parent process
+def combine_summaries(parent,shard_summaries):
+    workers = {}
+    for summary in shard_summaries:
+        worker = workers.setdefault(summary['pid'],{'pid':summary['pid'],'shards':0,'seconds':0.,'stages':{}})
+        worker['shards'] += 1
+        worker['seconds'] += summary['seconds']
+        add_stages(worker['stages'],summary['stages'])
+    workers = [workers[pid] for pid in sorted(workers)]
+    total = add_stages({},parent['stages'])
+    for worker in workers:
+        add_stages(total,worker['stages'])
+    return workers,{stage:total[stage] for stage in STAGES}
+
+def write_report(reportname,parent,shard_summaries,**run_info):
+    workers,total = combine_summaries(parent,shard_summaries)
+    report = {'command':sys.argv,'date':time.strftime('%Y-%m-%d %H:%M:%S'),'host':platform.node(),'python':platform.python_version()}
+    report.update(run_info)
+    report.update({'wall_seconds':parent['seconds'],'parent':parent,'workers':workers,'total':total})
+    with open(reportname,'w') as reportfi:
+        json.dump(report,reportfi,indent=1)
+    print('stage times summed over',len(workers),'workers and the main process:')
+    for stage in STAGES:
+        counters = ', '.join('%d %s' % (n,name) for name,n in sorted(total[stage].items()) if name != 'seconds')
+        print('  %-18s %9.2f s  %s' % (stage,total[stage]['seconds'],counters))
+    print('run report saved to',reportname)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#Synthetic nanopolish eventalign tsv and fastq for testing and benchmarking mCaller at a chosen scale: reads are drawn from
+#a reference, and each kmer along a read gets events around the model current of template_median68pA.model, shifted at
+#methylated sites
+
+import numpy as np
+import os
+
+from extract_contexts import methylate_references,revcomp
+from reference_index import get_fai,fetch_contig
+
+HEADER = 'contig\tposition\treference_kmer\tread_name\tstrand\tevent_index\tevent_level_mean\tevent_stdv\tevent_length\tmodel_kmer\tmodel_mean\tmodel_stdv\tstandardized_level\tsamples\n'
+BASE_CODES = {'A':0,'C':1,'G':2,'T':3}
+
+#current mean and standard deviation of every kmer in a nanopolish model file, indexed by the kmer read in base 4 over ACGT
+def load_model_levels(modelfile):
+    levels,stdvs = {},{}
+    with open(modelfile,'r') as modfi:
+        for line in modfi:
+            fields = line.split('\t')
+            if line.startswith('#') or fields[0] == 'kmer':
+                continue
+            levels[fields[0]],stdvs[fields[0]] = float(fields[1]),float(fields[2])
+    k = len(next(iter(levels)))
+    means,sds = np.zeros(4**k),np.zeros(4**k)
+    for kmer in levels:
+        code = kmer_codes(kmer,k)[0]
+        means[code],sds[code] = levels[kmer],stdvs[kmer]
+    return k,means,sds
+
+#base-4 code of the kmer starting at each position of seq (-1 where the kmer has a base other than ACGT)
+def kmer_codes(seq,k):
+    bases = np.full(256,-1,dtype=np.int64)
+    for nt,code in BASE_CODES.items():
+        bases[ord(nt)] = code
+    seq = bases[np.frombuffer(seq.encode(),dtype=np.uint8)]
+    n = len(seq)-k+1
+    if n <= 0:
+        return np.zeros(0,dtype=np.int64)
+    codes = np.zeros(n,dtype=np.int64)
+    bad = np.zeros(n,dtype=bool)
+    for i in range(k):
+        codes = codes*4+seq[i:i+n]
+        bad |= seq[i:i+n] < 0
+    codes[bad] = -1
+    return codes
+
+#code of the reverse complement of each kmer code
+def revcomp_codes(codes,k):
+    rc = np.zeros(len(codes),dtype=np.int64)
+    rest = codes.copy()
+    for i in range(k):
+        rc = rc*4+(3-rest%4)
+        rest //= 4
+    return np.where(codes < 0,-1,rc)
+
+def write_random_reference(filename,length,seed=0,name='synthetic'):
+    rng = np.random.RandomState(seed)
+    seq = ''.join(np.array(list('ACGT'))[rng.randint(4,size=length)])
+    with open(filename,'w') as ref:
+        ref.write('>'+name+'\n'+'\n'.join(seq[i:i+60] for i in range(0,len(seq),60))+'\n')
+
+#methylated sites of one contig as (forward sites, reverse sites, labels of each), 0-based. sites in a positions file keep
+#their labels (methylated if there are none), motif sites are methylated with probability meth_fraction
+def contig_sites(ref_seq,contig,base,motif,positions,meth_fraction,rng):
+    fwd,rev = methylate_references(ref_seq,base,motif=motif,positions=positions,contig=contig)
+    if positions:
+        labels = {}
+        with open(positions,'r') as posfi:
+            for line in posfi:
+                fields = line.split()
+                if len(fields) > 2 and fields[0] == contig:
+                    labels[(int(fields[1])-1,fields[2])] = fields[3] if len(fields) > 3 else 'm6A'
+        fwd_labels = np.array([labels[(site,'+')] for site in fwd.tolist()],dtype=object)
+        rev_labels = np.array([labels[(site,'-')] for site in rev.tolist()],dtype=object)
+    else:
+        meth_label = 'm6A' if base == 'A' else 'm5C'
+        fwd_labels = np.where(rng.uniform(size=len(fwd)) < meth_fraction,meth_label,base).astype(object)
+        rev_labels = np.where(rng.uniform(size=len(rev)) < meth_fraction,meth_label,base).astype(object)
+    return fwd,rev,fwd_labels,rev_labels
+
+#whether the kmer starting at each position covers a methylated site
+def covers_sites(sites,n,k):
+    hits = np.zeros(n+k,dtype=np.int64)
+    np.add.at(hits,np.maximum(sites-k+1,0),1)
+    np.add.at(hits,sites+1,-1)
+    return np.cumsum(hits)[:n] > 0
+
+#eventalign rows for one read over reference positions [start,end): each kmer position is skipped with probability skip,
+#and gets one or more events (another with probability stay). events are the model current (shifted by meth_shift if the
+#kmer covers a methylated site) plus noise times the model standard deviation
+def read_rows(contig,ref_seq,codes,covered,start,end,rev,read_name,k,means,sds,skip,stay,noise,meth_shift,rng):
+    positions = np.arange(start,end)
+    positions = positions[(codes[start:end] >= 0) & (rng.uniform(size=end-start) >= skip)]
+    nevents = rng.geometric(1-stay,size=len(positions))
+    positions = np.repeat(positions,nevents)
+    model_codes = revcomp_codes(codes[positions],k) if rev else codes[positions]
+    model_means = means[model_codes]
+    model_sds = sds[model_codes]
+    events = model_means+meth_shift*covered[positions]+rng.normal(size=len(positions))*noise*model_sds
+    event_index = np.arange(len(positions))[::-1]+1 if rev else np.arange(len(positions))+1
+    lengths = rng.exponential(0.004,size=len(positions))
+    rows = []
+    for i,pos in enumerate(positions.tolist()):
+        ref_kmer = ref_seq[pos:pos+k]
+        model_kmer = revcomp(ref_kmer) if rev else ref_kmer
+        rows.append('%s\t%d\t%s\t%s\tt\t%d\t%.2f\t%.3f\t%.5f\t%s\t%.2f\t%.2f\t%.2f\t%.3f\n' % (contig,pos,ref_kmer,read_name,event_index[i],events[i],model_sds[i],
+                    lengths[i],model_kmer,model_means[i],model_sds[i],(events[i]-model_means[i])/model_sds[i],events[i]))
+    return rows
+
+#write an eventalign tsv, fastq and positions file with labels for nreads reads (or enough reads for the given coverage).
+#read lengths are drawn around read_length, reads are on either strand and are written in order of contig and start
+def generate(refname,modelfile,output,base='A',motif=None,positions=None,nreads=None,coverage=None,read_length=5000,noise=1.,
+             skip=0.1,stay=0.3,meth_shift=-2.,meth_fraction=0.5,seed=0):
+    rng = np.random.RandomState(seed)
+    k,means,sds = load_model_levels(modelfile)
+    fai = get_fai(refname)
+    contigs = list(fai)
+    lengths = np.array([fai[contig][0] for contig in contigs],dtype=np.int64)
+    if nreads is None:
+        nreads = int(np.ceil(coverage*lengths.sum()/float(read_length)))
+    read_contigs = np.sort(rng.choice(len(contigs),size=nreads,p=lengths/float(lengths.sum())))
+    tsvname,fastqname,posname = output+'.eventalign.tsv',output+'.fastq',output+'.positions.txt'
+    tsv,fastq,posfi = open(tsvname,'w'),open(fastqname,'w'),open(posname,'w')
+    tsv.write(HEADER)
+    nrows,nsites,readnum = 0,0,0
+    for c,contig in enumerate(contigs):
+        ncontig_reads = int((read_contigs == c).sum())
+        ref_seq = fetch_contig(refname,contig)
+        fwd,rev,fwd_labels,rev_labels = contig_sites(ref_seq,contig,base,motif,positions,meth_fraction,rng)
+        for sites,labels,site_strand in [(fwd,fwd_labels,'+'),(rev,rev_labels,'-')]:
+            for site,label in zip(sites.tolist(),labels.tolist()):
+                posfi.write('%s\t%d\t%s\t%s\n' % (contig,site+1,site_strand,label))
+        nsites += len(fwd)+len(rev)
+        if ncontig_reads == 0 or len(ref_seq) <= k:
+            continue
+        codes = kmer_codes(ref_seq,k)
+        meth_sites = [np.array([site for site,label in zip(sites.tolist(),labels.tolist()) if label.startswith('m')],dtype=np.int64) for sites,labels in [(fwd,fwd_labels),(rev,rev_labels)]]
+        covered = [covers_sites(sites,len(codes),k) for sites in meth_sites]
+        spans = np.minimum(np.maximum(rng.gamma(4.,read_length/4.,size=ncontig_reads).astype(np.int64),k),len(codes))
+        starts = rng.randint(len(codes)-spans+1)
+        order = np.argsort(starts,kind='stable')
+        for start,span in zip(starts[order].tolist(),spans[order].tolist()):
+            readnum += 1
+            rev_read = rng.uniform() < 0.5
+            read_name = '%08x-%04x-%04x-synthetic%d_Basecall_2D_template' % (rng.randint(1<<30),rng.randint(1<<16),rng.randint(1<<16),readnum)
+            rows = read_rows(contig,ref_seq,codes,covered[1 if rev_read else 0],start,start+span,rev_read,read_name,k,means,sds,skip,stay,noise,meth_shift,rng)
+            tsv.writelines(rows)
+            nrows += len(rows)
+            seq = revcomp(ref_seq[start:start+span+k-1],rev_read)
+            fastq.write('@%s\n%s\n+\n%s\n' % (read_name,seq,''.join(chr(33+q) for q in rng.randint(5,20,size=len(seq)))))
+    for fi in [tsv,fastq,posfi]:
+        fi.close()
+    print(readnum,'reads,',nrows,'eventalign rows,',nsites,'sites written to',tsvname,fastqname,posname)
+    return {'reads':readnum,'rows':nrows,'sites':nsites,'tsv':tsvname,'fastq':fastqname,'positions':posname}
+
+def main():
+    #parse command line options
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Write a synthetic nanopolish eventalign tsv with matching fastq and labelled positions')
+    all_or_some = parser.add_mutually_exclusive_group(required=True)
+    all_or_some.add_argument('-p','--positions',type=str,required=False,help='file of positions to methylate (chromosome, position, strand and optionally label, as for mCaller)')
+    all_or_some.add_argument('-m','--motif',type=str,required=False,help='methylate --base in every occurrence of this motif, with probability --meth_fraction per site')
+    parser.add_argument('-r','--reference',type=str,required=True,help='fasta file to draw reads from')
+    parser.add_argument('--model',type=str,required=False,help='nanopolish kmer model with current levels (default template_median68pA.model)',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'template_median68pA.model'))
+    parser.add_argument('-o','--output',type=str,required=True,help='output prefix: writes <output>.eventalign.tsv, <output>.fastq and <output>.positions.txt')
+    reads_or_coverage = parser.add_mutually_exclusive_group(required=True)
+    reads_or_coverage.add_argument('-n','--reads',type=int,required=False,help='number of reads')
+    reads_or_coverage.add_argument('-c','--coverage',type=float,required=False,help='mean coverage of the reference')
+    parser.add_argument('-l','--read_length',type=int,required=False,help='mean read length (default 5000)',default=5000)
+    parser.add_argument('-b','--base',type=str,required=False,help='methylated base (A or C, default A)',default='A')
+    parser.add_argument('--noise',type=float,required=False,help='event noise as a multiple of the model standard deviation (default 1.0)',default=1.)
+    parser.add_argument('--skip',type=float,required=False,help='probability that a kmer has no event (default 0.1)',default=0.1)
+    parser.add_argument('--stay',type=float,required=False,help='probability of each further event on the same kmer (default 0.3)',default=0.3)
+    parser.add_argument('--meth_shift',type=float,required=False,help='current shift in pA of kmers covering a methylated site (default -2)',default=-2.)
+    parser.add_argument('--meth_fraction',type=float,required=False,help='fraction of motif sites that are methylated (default 0.5)',default=0.5)
+    parser.add_argument('--seed',type=int,required=False,help='random seed (default 0)',default=0)
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.reference), 'reference file not found at '+args.reference
+    assert 0 <= args.skip < 1 and 0 <= args.stay < 1, '--skip and --stay must be between 0 and 1'
+    generate(args.reference,args.model,args.output,base=args.base,motif=args.motif,positions=args.positions,nreads=args.reads,coverage=args.coverage,
+             read_length=args.read_length,noise=args.noise,skip=args.skip,stay=args.stay,meth_shift=args.meth_shift,meth_fraction=args.meth_fraction,seed=args.seed)
+
+if __name__ == "__main__":
+    main()
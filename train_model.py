@@ -1,22 +1,33 @@
 import pickle
 import numpy as np
+import os
+import time
+import shutil
+import multiprocessing
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import GridSearchCV
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn import svm
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression,SGDClassifier
 from sklearn.naive_bayes import GaussianNB
+from sklearn.multiclass import OneVsRestClassifier
 
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import GroupKFold
 from sklearn.model_selection import GroupShuffleSplit
+from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import ParameterGrid
+from sklearn.model_selection import ParameterSampler
 from sklearn.ensemble import GradientBoostingClassifier
 
-#make position to label dict for training
+from numpy_model import WEIGHTS_VERSION,weights_name
+from profiling import start_profile,profile_settings,profiled,memory_snapshot
+
+#make (contig, position, strand) to label dict for training
 def pos2label(positions):
-   pos2label_dict = {(int(pos.split()[1])-1,pos.split()[2]):pos.split()[3] for pos in open(positions,'r').read().split('\n') if len(pos.split()) > 1}
-   print(pos2label_dict)
+   pos2label_dict = {(pos.split()[0],int(pos.split()[1])-1,pos.split()[2]):pos.split()[3] for pos in open(positions,'r').read().split('\n') if len(pos.split()) > 1}
+   print(len(pos2label_dict),'labeled positions')
    return pos2label_dict
 
 #to show best results of parameter grid search
@@ -31,53 +42,260 @@ def report(results, n_top):
             print("Parameters: {0}".format(results['params'][candidate]))
             print("")
 
-def train_classifier(signals,labels,groups,modelfile,classifier='NN'): #TODO: set order of labels
+#the classifier with mCaller's default settings; RF trees are built in nprocs processes
+def make_classifier(classifier,nprocs=1):
    classifier = classifier.split('_')[0]
    if classifier == 'RF':
       model = RandomForestClassifier(bootstrap=True, class_weight=None, criterion='entropy',
           max_depth=10, max_features=4, max_leaf_nodes=None,
-          min_impurity_split=3.93927246304e-06, min_samples_leaf=2,
+          min_samples_leaf=2,
           min_samples_split=3, min_weight_fraction_leaf=0.0,
-          n_estimators=50, n_jobs=15, oob_score=False, random_state=None,
+          n_estimators=50, n_jobs=nprocs, oob_score=False, random_state=None,
           verbose=0, warm_start=False)
-          #param_grid = {'bootstrap':[True,False],'n_estimators':[40,50,60,100],'max_depth':[5,8,10,12],'max_features':[1,2,3,4],'min_samples_leaf':[1,2,3,10],'n_jobs':[15]}          
    elif classifier == 'NN':
-      #param_grid = {'hidden_layer_sizes':[(4,4,4,4.4),(100),(100,100,100),(100,100,100,100)],'alpha':[0.001],'learning_rate':['adaptive'],'early_stopping':[False],'activation':['tanh']}
       model = MLPClassifier(hidden_layer_sizes=(100), alpha=0.001,learning_rate='adaptive',early_stopping=False,activation='tanh') #solver='lbfgs', alpha=1e-5, hidden_layer_sizes=(4), activation='tanh', random_state=1)
     
    elif classifier == 'SVM':
-      #param_grid = {'kernel':['poly','rbf','sigmoid'],'degree':[3,5],'tol':[1e-3],'shrinking':[True,False],'gamma':['auto']} #,0.1,0.01,0.001]}
       model = svm.SVC(kernel='rbf',probability=True)
 
    elif classifier == 'LR':
-      #param_grid = {'solver':['liblinear'],'multi_class':['ovr'],'penalty':['l1']}
-      model = LogisticRegression(solver='liblinear',multi_class='ovr',penalty='l1')
+      #one-vs-rest with L1 penalty (l1_ratio=1); liblinear only fits two classes at a time
+      model = OneVsRestClassifier(LogisticRegression(solver='liblinear',l1_ratio=1))
  
    elif classifier == 'NBC':
       model = GaussianNB()
+   return model
+
+#parameters tried by --search, on top of the defaults in make_classifier
+SEARCH_GRIDS = {'RF':{'bootstrap':[True,False],'n_estimators':[40,50,60,100],'max_depth':[5,8,10,12],'max_features':[1,2,3,4],'min_samples_leaf':[1,2,3,10]},
+                'NN':{'hidden_layer_sizes':[(4,4,4,4),(100,),(100,100,100),(100,100,100,100)],'alpha':[0.001,0.0001],'activation':['tanh','relu']},
+                'SVM':{'kernel':['poly','rbf','sigmoid'],'degree':[3,5],'shrinking':[True,False]},
+                'LR':{'estimator__l1_ratio':[0,1],'estimator__C':[0.1,1.0,10.0]},
+                'NBC':{'var_smoothing':[1e-9,1e-8,1e-7]}}
+
+def train_classifier(signals,labels,groups,modelfile,classifier='NN',nprocs=1,search=0): #TODO: set order of labels
+   if search:
+      model = search_classifier(signals,labels,groups,classifier,nprocs,search,modelfile+'.search')
+      save_model(model,modelfile)
+      return model
+   model = make_classifier(classifier,nprocs)
 
-   if groups:
+   if groups is not None and len(groups):
       gfk = GroupKFold(n_splits=5)
    else:
       gfk = 5
         
-   #combinations = 1
-   #niter = 1
-   #for param in param_grid:
-   #   combinations = combinations*len(param_grid[param]) 
-   #random_search = RandomizedSearchCV(model, param_distributions = param_grid, n_iter=min(1,combinations))
-   #random_search.fit(signals,labels)
-   #report(random_search.cv_results_,min(1,combinations))
-   #model=None        
-
    scores = cross_val_score(model,signals,labels,cv=gfk,groups=groups)
    print(scores)
    print("Accuracy: %0.2f (+/- %0.2f)" % (scores.mean(), scores.std() * 2))
 
    model.fit(signals,labels)
-  
+   save_model(model,modelfile)
+   return model
+
+def save_model(model,modelfile):
    modfi = open(modelfile,'wb')
    pickle.dump(model,modfi)
    modfi.close()
+   try:
+      export_model(model,weights_name(modelfile))
+   except ValueError as err:
+      print(err)
+
+#fold matrices and labels saved by search_classifier, memory-mapped once by each search process
+search_folds = {}
+
+def init_search(cachedir,nfolds,profile=None):
+   if profile is not None:
+      start_profile(role='search',**profile)
+   for fold in range(nfolds):
+      search_folds[fold] = [np.load(os.path.join(cachedir,'fold%d_%s.npy' % (fold,part)),mmap_mode='r') for part in ['Xtrain','ytrain','Xtest','ytest']]
+
+#fit one candidate on one fold, returning its accuracy on the fold's test set and the time taken. each process fits one
+#model at a time on one thread, so the processes together stay within the --threads budget
+def fit_fold(task):
+   from threadpoolctl import threadpool_limits
+   candidate,fold,classifier,params = task
+   Xtrain,ytrain,Xtest,ytest = search_folds[fold]
+   tstart = time.time()
+   with profiled(),threadpool_limits(1):
+      model = make_classifier(classifier,1).set_params(**params)
+      model.fit(Xtrain,ytrain)
+      score = model.score(Xtest,ytest)
+      memory_snapshot()
+   return candidate,fold,score,time.time()-tstart
+
+#grid search over SEARCH_GRIDS (or a random sample of ncandidates from it) with 5 folds that keep contexts apart. the fold
+#matrices are written once to cachedir, and every (candidate, fold) fit is a task for a pool of nprocs
+#processes. returns the best candidate refit on all the data
+def search_classifier(signals,labels,groups,classifier,nprocs,ncandidates,cachedir):
+   classifier = classifier.split('_')[0]
+   grid = SEARCH_GRIDS[classifier]
+   if len(ParameterGrid(grid)) <= ncandidates:
+      candidates = list(ParameterGrid(grid))
+   else:
+      candidates = list(ParameterSampler(grid,ncandidates,random_state=0))
+   if groups is not None and len(groups):
+      folds = list(GroupKFold(n_splits=5).split(signals,labels,groups))
+   else:
+      folds = list(StratifiedKFold(n_splits=5).split(signals,labels))
+   if not os.path.isdir(cachedir):
+      os.mkdir(cachedir)
+   for fold,(train,test) in enumerate(folds):
+      for part,values in [('Xtrain',signals[train]),('ytrain',labels[train]),('Xtest',signals[test]),('ytest',labels[test])]:
+         np.save(os.path.join(cachedir,'fold%d_%s.npy' % (fold,part)),values)
+   print(len(candidates),'candidates x',len(folds),'folds in',nprocs,'processes')
+
+   tasks = [(candidate,fold,classifier,params) for candidate,params in enumerate(candidates) for fold in range(len(folds))]
+   if nprocs > 1:
+      pool = multiprocessing.Pool(nprocs,initializer=init_search,initargs=(cachedir,len(folds),profile_settings()))
+      results = pool.imap_unordered(fit_fold,tasks)
+   else:
+      init_search(cachedir,len(folds))
+      results = map(fit_fold,tasks)
+   scores = np.zeros((len(candidates),len(folds)))
+   fit_times = np.zeros((len(candidates),len(folds)))
+   remaining = [len(folds)]*len(candidates)
+   tstart = time.time()
+   for candidate,fold,score,fit_time in results:
+      scores[candidate,fold] = score
+      fit_times[candidate,fold] = fit_time
+      remaining[candidate] -= 1
+      if remaining[candidate] == 0:
+         print('candidate %d: accuracy %0.3f (+/- %0.3f), fit time %0.1f s (%0.1f s elapsed) %s' % (candidate,scores[candidate].mean(),scores[candidate].std()*2,
+               fit_times[candidate].sum(),time.time()-tstart,candidates[candidate]))
+   if nprocs > 1:
+      pool.close()
+      pool.join()
+   search_folds.clear()
+   shutil.rmtree(cachedir)
+
+   mean_scores = scores.mean(axis=1)
+   ranks = np.empty(len(candidates),dtype=int)
+   ranks[np.argsort(-mean_scores,kind='stable')] = np.arange(1,len(candidates)+1)
+   report({'rank_test_score':ranks,'mean_test_score':mean_scores,'std_test_score':scores.std(axis=1),'params':candidates},min(3,len(candidates)))
+   best = candidates[int(np.argmax(mean_scores))]
+   print('refitting with',best)
+   model = make_classifier(classifier,nprocs).set_params(**best)
+   model.fit(signals,labels)
    return model
 
+#records read at a time when training incrementally
+TRAIN_BATCH_ROWS = 1<<16
+
+#classifiers with partial_fit, for training on more observations than fit in memory. LR is fit by stochastic gradient descent
+def incremental_classifier(classifier):
+   classifier = classifier.split('_')[0]
+   if classifier == 'NN':
+      return MLPClassifier(hidden_layer_sizes=(100), alpha=0.001,learning_rate='adaptive',early_stopping=False,activation='tanh')
+   elif classifier == 'NBC':
+      return GaussianNB()
+   elif classifier == 'LR':
+      return SGDClassifier(loss='log_loss',penalty='l1')
+   raise ValueError('classifier '+classifier+' cannot be trained incrementally, use NN, NBC or LR')
+
+#observations held out for validation, chosen by a hash of their context so that, as with GroupKFold, a context is never
+#both trained on and validated
+def heldout_rows(groups,holdout):
+   hashed = (np.asarray(groups).astype(np.uint64)*np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(54)
+   return hashed < holdout*1024
+
+#train with partial_fit over batches of (signals, label codes, contexts) from batches(rng), which reads the training data in a
+#random order without holding it all in memory. held-out observations are copied to a file on the first pass, and are
+#scored after every pass in place of cross-validation
+def train_incremental(batches,classes,modelfile,classifier='NN',epochs=5,holdout=0.2,seed=0):
+   model = incremental_classifier(classifier)
+   classes = np.asarray(classes)
+   rng = np.random.RandomState(seed)
+   holdoutname = modelfile+'.holdout'
+   holdoutfi = open(holdoutname,'wb')
+   holdout_dtype = None
+   ntrain,nheld = 0,0
+   for epoch in range(epochs):
+      for signals,codes,groups in batches(rng):
+         held = heldout_rows(groups,holdout)
+         if epoch == 0 and held.any():
+            if holdout_dtype is None:
+               holdout_dtype = np.dtype([('features',np.float32,(signals.shape[1],)),('label',np.uint8)])
+            records = np.empty(int(held.sum()),dtype=holdout_dtype)
+            records['features'],records['label'] = signals[held],codes[held]
+            holdoutfi.write(records.tobytes())
+            nheld += len(records)
+         if not held.all():
+            model.partial_fit(signals[~held],classes[codes[~held]],classes=classes)
+            if epoch == 0:
+               ntrain += int((~held).sum())
+      if epoch == 0:
+         holdoutfi.close()
+         print(ntrain,'observations for training,',nheld,'held out')
+         assert ntrain > 0, 'no observations left for training'
+      if nheld:
+         correct = 0
+         for start in range(0,nheld,TRAIN_BATCH_ROWS):
+            records = np.fromfile(holdoutname,dtype=holdout_dtype,count=min(TRAIN_BATCH_ROWS,nheld-start),offset=start*holdout_dtype.itemsize)
+            correct += int((model.predict(records['features']) == classes[records['label']]).sum())
+         print('epoch',epoch+1,'held-out accuracy: %0.2f' % (correct/float(nheld)))
+   os.remove(holdoutname)
+   save_model(model,modelfile)
+   return model
+
+#save the parameters of a trained classifier as numpy arrays, to be run by numpy_model.py without scikit-learn
+def export_model(model,weightsfile):
+   weights = {'version':WEIGHTS_VERSION,'classes':np.asarray(model.classes_).astype(str)}
+   if isinstance(model,MLPClassifier):
+      weights.update({'kind':'MLP','activation':model.activation,'out_activation':model.out_activation_,'nlayers':len(model.coefs_)})
+      for i,(coef,intercept) in enumerate(zip(model.coefs_,model.intercepts_)):
+         weights['coef_%d' % i] = coef
+         weights['intercept_%d' % i] = intercept
+   elif isinstance(model,SGDClassifier):
+      weights.update({'kind':'LR','coef':model.coef_,'intercept':model.intercept_,'multi_class':'ovr'})
+   elif isinstance(model,LogisticRegression):
+      #with more than two classes, LogisticRegression is multinomial unless fit one-vs-rest by liblinear or an older
+      #scikit-learn's multi_class='ovr' ('warn' was its default)
+      ovr = model.solver == 'liblinear' or getattr(model,'multi_class',None) in ['ovr','warn']
+      weights.update({'kind':'LR','coef':model.coef_,'intercept':model.intercept_,'multi_class':'ovr' if ovr else 'multinomial'})
+   elif isinstance(model,OneVsRestClassifier) and all(hasattr(estimator,'coef_') for estimator in model.estimators_):
+      #one binary model per class (a single one for two classes), stacked as one LR model
+      weights.update({'kind':'LR','coef':np.vstack([estimator.coef_ for estimator in model.estimators_]),
+                      'intercept':np.concatenate([estimator.intercept_ for estimator in model.estimators_]),'multi_class':'ovr'})
+   elif isinstance(model,GaussianNB):
+      weights.update({'kind':'NBC','theta':model.theta_,'var':model.var_ if hasattr(model,'var_') else model.sigma_,'class_prior':model.class_prior_})
+   elif isinstance(model,RandomForestClassifier):
+      #trees are flattened into one set of node arrays, with child indices offset to the tree's first node
+      left,right,feature,threshold,value,roots = [],[],[],[],[],[]
+      offset = 0
+      for estimator in model.estimators_:
+         tree = estimator.tree_
+         leaf = tree.children_left < 0
+         left.append(np.where(leaf,-1,tree.children_left+offset))
+         right.append(np.where(leaf,-1,tree.children_right+offset))
+         feature.append(tree.feature)
+         threshold.append(tree.threshold)
+         counts = tree.value[:,0,:]
+         totals = counts.sum(axis=1)
+         value.append(counts/np.where(totals == 0,1,totals)[:,None])
+         roots.append(offset)
+         offset += tree.node_count
+      weights.update({'kind':'RF','left':np.concatenate(left),'right':np.concatenate(right),'feature':np.concatenate(feature),
+                      'threshold':np.concatenate(threshold),'value':np.concatenate(value),'roots':np.array(roots)})
+   else:
+      raise ValueError('cannot export '+type(model).__name__+' to a weights file, only the pickled model was saved')
+   with open(weightsfile,'wb') as weightsfi:
+      np.savez(weightsfi,**weights)
+   print('saved weights to',weightsfile)
+
+#convert a pickled model to a weights file
+def main():
+   from argparse import ArgumentParser
+   parser = ArgumentParser(description='Export a pickled classifier to a numpy weights file')
+   parser.add_argument('-d','--modelfile',type=str,required=True,help='pickled model file')
+   parser.add_argument('-o','--output',type=str,required=False,help='weights file (default: model file name with .npz)')
+   args = parser.parse_args()
+   modfi = open(args.modelfile,'rb')
+   model = pickle.load(modfi, encoding='bytes')
+   modfi.close()
+   export_model(model,args.output or weights_name(args.modelfile))
+
+if __name__ == "__main__":
+   main()
+